@@ -0,0 +1,95 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+# What it takes to render one album page: the client fan-out of /albums/<id>, then
+# /songs/by_album/<id>, then /artists/<id> for each artist of the album and its songs,
+# against the one /albums/<id>/full request (DB.find_album_full).
+#
+# Builds a database from data/full (replicated --scale times, see lookups.py), then
+# fetches --albums random album pages both ways through the Flask app's test client (the
+# WSGI app in process, without sockets, so there is no network round trip in these
+# numbers), with the lookup cache off and then on (timings are the best of three passes,
+# so with the cache on every page is already cached). Also counts the SQL statements each
+# way runs per page, from the query registry.
+#
+# from the repository root:
+#   python3 bench/album_page.py --albums 200 --scale 20
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from lookups import ALBUMS_FILE, ID_STRIDE, build  # noqa: E402
+from queries import QUERIES  # noqa: E402
+
+
+def fan_out(client, album_id):
+    album = client.get("/albums/%d" % album_id).get_json()[0]
+    songs = client.get("/songs/by_album/%d" % album_id).get_json()
+    artist_ids = set(album["artist_ids"]) | {a for song in songs for a in song["artist_ids"]}
+    artists = {a: client.get("/artists/%d" % a).get_json()[0] for a in sorted(artist_ids)}
+    return album, songs, artists, 2 + len(artists)
+
+
+def full(client, album_id):
+    return client.get("/albums/%d/full" % album_id).get_json(), 1
+
+
+# (milliseconds per page, requests per page, statements per page), best of repeat runs
+def per_page(fetch, client, album_ids, repeat=3):
+    best = None
+    for _ in range(repeat):
+        QUERIES.reset()
+        requests = 0
+        start = time.perf_counter()
+        for album_id in album_ids:
+            requests += fetch(client, album_id)[-1]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        statements = sum(stats["calls"] for stats in QUERIES.stats().values())
+    return best * 1000 / len(album_ids), requests / len(album_ids), statements / len(album_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--albums", help="album pages to fetch (default 200)", default=200, type=int)
+    parser.add_argument("--scale", help="copies of data/full to load (default 20)", default=20, type=int)
+    config = parser.parse_args()
+
+    with open(ALBUMS_FILE, "r") as f:
+        albums = json.load(f)["values"]
+    rng = random.Random(42)
+    album_ids = [rng.choice(albums)["album_id"] + rng.randrange(config.scale) * ID_STRIDE
+                 for _ in range(config.albums)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        build(os.path.join(tmp, "splatDB.sqlite3"), albums, config.scale).close()
+        # the app opens splatDB.sqlite3 in the working directory
+        os.chdir(tmp)
+        import app  # noqa: E402
+        app.app.config['SLOW_QUERY_MS'] = None
+        logging.disable(logging.ERROR)
+        client = app.app.test_client()
+
+        # both ways must give the same page
+        for album_id in album_ids[:20]:
+            album, songs, artists, _ = fan_out(client, album_id)
+            doc = full(client, album_id)[0]
+            assert doc["songs"] == songs and doc["artist_ids"] == album["artist_ids"]
+            assert doc["artists"] == {str(a): artist for a, artist in artists.items()}
+
+        print("%d album pages, %d albums in the catalog" % (len(album_ids), len(albums) * config.scale))
+        print("%-6s %-22s %8s %10s %12s" % ("cache", "", "ms/page", "requests", "statements"))
+        for cache_size in (0, 10000):
+            app.app.config['CACHE_SIZE'] = cache_size
+            app._cache = None
+            for label, fetch in (("fan-out", fan_out), ("/albums/<id>/full", full)):
+                ms, requests, statements = per_page(fetch, client, album_ids)
+                print("%-6s %-22s %8.3f %10.1f %12.1f" % ("on" if cache_size else "off", label, ms, requests,
+                                                          statements))
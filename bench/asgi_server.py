@@ -0,0 +1,117 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import urllib.parse
+
+# A bare-bones HTTP/1.1 server for server/asgi.py, so bench/serving.py can compare the
+# ASGI entry point with `flask run` using only the allowed packages. Keep-alive,
+# Content-Length request bodies and Content-Length or close delimited responses; no
+# chunked requests, TLS or HTTP/2.
+#
+# Benchmarks only: it has no timeouts and no limits on header or body size, and trusts
+# Content-Length. Serve the ASGI app with uvicorn or hypercorn (see server/asgi.py).
+#
+# from the server directory (the database and schema/ are found relative to it):
+#   python3 ../bench/asgi_server.py --port 5001
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+
+from asgi import app  # noqa: E402
+
+REASONS = {200: b"OK", 201: b"Created", 202: b"Accepted", 400: b"Bad Request", 404: b"Not Found",
+           405: b"Method Not Allowed", 411: b"Length Required", 500: b"Internal Server Error",
+           503: b"Service Unavailable"}
+
+
+async def handle_connection(asgi_app, reader, writer):
+    peer = writer.get_extra_info("peername")
+    sock = writer.get_extra_info("sockname")
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            lines = head.decode("latin-1").split("\r\n")
+            method, target, version = lines[0].split(" ", 2)
+            headers = []
+            length = 0
+            keep_alive = version == "HTTP/1.1"
+            for line in lines[1:]:
+                if not line:
+                    continue
+                name, value = line.split(":", 1)
+                name, value = name.strip().lower(), value.strip()
+                headers.append((name.encode("latin-1"), value.encode("latin-1")))
+                if name == "content-length":
+                    length = int(value)
+                elif name == "connection":
+                    keep_alive = value.lower() == "keep-alive" or (keep_alive and value.lower() != "close")
+                elif name == "transfer-encoding":
+                    writer.write(b"HTTP/1.1 411 Length Required\r\ncontent-length: 0\r\nconnection: close\r\n\r\n")
+                    return
+            body = await reader.readexactly(length) if length else b""
+            path, _, query = target.partition("?")
+            scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": version[5:],
+                     "method": method, "scheme": "http", "path": urllib.parse.unquote(path),
+                     "raw_path": path.encode("latin-1"), "query_string": query.encode("latin-1"),
+                     "root_path": "", "headers": headers, "client": peer, "server": sock}
+            if not await run_asgi(asgi_app, scope, body, writer, keep_alive):
+                return
+    except Exception:
+        logging.exception("error serving request")
+    finally:
+        writer.close()
+
+
+# runs one request through the app and writes the response. returns whether the
+# connection can take another request
+async def run_asgi(asgi_app, scope, body, writer, keep_alive):
+    received = False
+    state = {"framed": False}
+
+    async def receive():
+        nonlocal received
+        if received:
+            return {"type": "http.disconnect"}
+        received = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            out = [b"HTTP/1.1 %d %s" % (status, REASONS.get(status, b""))]
+            for name, value in message.get("headers", ()):
+                if name.lower() == b"content-length":
+                    state["framed"] = True
+                out.append(name + b": " + value)
+            if not (keep_alive and state["framed"]):
+                out.append(b"connection: close")
+            writer.write(b"\r\n".join(out) + b"\r\n\r\n")
+        elif message["type"] == "http.response.body":
+            writer.write(message.get("body", b""))
+            await writer.drain()
+
+    await asgi_app(scope, receive, send)
+    return keep_alive and state["framed"]
+
+
+async def serve(asgi_app, host, port):
+    server = await asyncio.start_server(lambda r, w: handle_connection(asgi_app, r, w), host, port, backlog=1024)
+    logging.warning("serving ASGI app on http://%s:%d", host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", help="address to listen on (default 127.0.0.1)", default="127.0.0.1")
+    parser.add_argument("-p", "--port", help="port to listen on (default 5001)", default=5001, type=int)
+    config = parser.parse_args()
+    try:
+        asyncio.run(serve(app, config.host, config.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,102 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Fetching many songs, albums or artists at once: one batch lookup (/songs?ids=...,
+# DB.find_songs, a fixed number of set-based queries) against one /songs/<id> lookup per id
+# (DB.find_song, three queries each).
+#
+# Builds a database from data/full (replicated --scale times, see lookups.py), then for
+# --ids random ids of each kind, a tenth of them unknown, times both ways twice: calling
+# the DB methods directly, and as requests through the Flask app's test client (the WSGI
+# app in process, without sockets), so the second column adds the per-request cost that a
+# client pays even before the network. The lookup cache is off.
+#
+# from the repository root:
+#   python3 bench/batch.py --ids 200 --scale 20
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from db import DB, KeyNotFound  # noqa: E402
+from lookups import ALBUMS_FILE, ID_STRIDE, build  # noqa: E402
+
+
+# milliseconds per call of fn(), best of repeat runs
+def time_ms(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def one_by_one(method, ids):
+    def run():
+        for i in ids:
+            try:
+                method(i)
+            except KeyNotFound:
+                pass
+    return run
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ids", help="ids per lookup (default 200)", default=200, type=int)
+    parser.add_argument("--scale", help="copies of data/full to load (default 20)", default=20, type=int)
+    config = parser.parse_args()
+
+    with open(ALBUMS_FILE, "r") as f:
+        albums = json.load(f)["values"]
+    rng = random.Random(42)
+    known = {
+        "songs": sorted({s["song_id"] for a in albums for s in a["songs"]}),
+        "albums": sorted({a["album_id"] for a in albums}),
+        "artists": sorted({artist["artist_id"] for a in albums for artist in a["artists"]}),
+    }
+    ids = {}
+    for kind, base in known.items():
+        sample = [rng.choice(base) + rng.randrange(config.scale) * ID_STRIDE for _ in range(config.ids)]
+        # unknown ids, which the batch reports as missing
+        sample[::10] = [config.scale * ID_STRIDE + i for i in range(len(sample[::10]))]
+        ids[kind] = list(dict.fromkeys(sample))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        build(os.path.join(tmp, "splatDB.sqlite3"), albums, config.scale).close()
+        # the app opens splatDB.sqlite3 in the working directory
+        os.chdir(tmp)
+        from app import app, get_db_conn  # noqa: E402
+        app.config['CACHE_SIZE'] = 0
+        app.config['SLOW_QUERY_MS'] = None
+        client = app.test_client()
+        # the views log every unknown id
+        logging.disable(logging.ERROR)
+
+        print("%d ids per lookup (a tenth unknown), %d albums" % (config.ids, len(albums) * config.scale))
+        print("%-8s %-10s %12s %12s %9s" % ("kind", "through", "one by one", "batch", "speedup"))
+        with app.app_context():
+            db = DB(get_db_conn())
+            for kind, kind_ids in ids.items():
+                single = getattr(db, "find_" + kind[:-1])
+                batch = getattr(db, "find_" + kind)
+                res = batch(kind_ids)
+                assert len(res[kind]) + len(res["missing"]) == len(kind_ids)
+                t_one = time_ms(one_by_one(single, kind_ids))
+                t_batch = time_ms(lambda: batch(kind_ids))
+                print("%-8s %-10s %9.2f ms %9.2f ms %8.1fx" % (kind, "DB", t_one, t_batch, t_one / t_batch))
+
+        for kind, kind_ids in ids.items():
+            paths = ["/%s/%d" % (kind, i) for i in kind_ids]
+            query = "/%s?ids=%s" % (kind, ",".join(map(str, kind_ids)))
+            t_one = time_ms(lambda: [client.get(path) for path in paths])
+            t_batch = time_ms(lambda: client.get(query))
+            print("%-8s %-10s %9.2f ms %9.2f ms %8.1fx" % (kind, "WSGI app", t_one, t_batch, t_one / t_batch))
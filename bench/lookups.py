@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+# Lookup latency of the DB read methods with and without the song_album/artist_album
+# keys and the secondary indexes from schema/create.sql (migration 001).
+#
+# Loads data/full (optionally replicated --scale times under shifted ids to get a bigger
+# catalog), then times every lookup method on the same random ids against two copies of
+# the database: "before" has the pre-001 layout, "after" the current schema.
+#
+# from the repository root:
+#   python3 bench/lookups.py --scale 20
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+
+from db import DB, KeyNotFound  # noqa: E402
+
+CREATE_SQL = os.path.join(ROOT, "server", "schema", "create.sql")
+ALBUMS_FILE = os.path.join(ROOT, "data", "full", "add-fullalbum.json")
+
+# shift applied to every id for each copy of the catalog
+ID_STRIDE = 100000
+
+# turns a current database back into the layout before migration 001:
+# song_album/artist_album as plain heap tables and no secondary indexes
+PRE_001 = """
+DROP INDEX song_artist_by_artist;
+CREATE TABLE song_album_old AS SELECT song_id, album_id, order_in_album FROM song_album;
+DROP TABLE song_album;
+ALTER TABLE song_album_old RENAME TO song_album;
+CREATE TABLE artist_album_old AS SELECT artist_id, album_id FROM artist_album;
+DROP TABLE artist_album;
+ALTER TABLE artist_album_old RENAME TO artist_album;
+"""
+
+
+def shifted(album, offset):
+    def artist(a):
+        return {"artist_id": a["artist_id"] + offset, "artist_name": a["artist_name"], "country": a["country"]}
+    return {
+        "album_id": album["album_id"] + offset,
+        "album_name": album["album_name"],
+        "release_year": album["release_year"],
+        "artists": [artist(a) for a in album["artists"]],
+        "songs": [{"song_id": s["song_id"] + offset, "song_name": s["song_name"], "length": s["length"],
+                   "artists": [artist(a) for a in s["artists"]]} for s in album["songs"]],
+    }
+
+
+def build(path, albums, scale):
+    conn = sqlite3.connect(path)
+    db = DB(conn)
+    with open(CREATE_SQL, "r") as f:
+        conn.executescript(f.read())
+    db.add_albums(shifted(a, k * ID_STRIDE) for k in range(scale) for a in albums)
+    return conn
+
+
+def time_lookups(db, method, ids, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in ids:
+            try:
+                method(db, i)
+            except KeyNotFound:
+                pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(ids) * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", help="copies of data/full to load (default 1)", default=1, type=int)
+    parser.add_argument("--lookups", help="ids looked up per method (default 300)", default=300, type=int)
+    parser.add_argument("--repeat", help="runs per method, best is kept (default 3)", default=3, type=int)
+    config = parser.parse_args()
+
+    with open(ALBUMS_FILE, "r") as f:
+        albums = json.load(f)["values"]
+    rng = random.Random(42)
+
+    def sample(key):
+        ids = [a[key] for a in albums] if key == "album_id" else \
+            sorted({x[key] for a in albums for x in (a["songs"] if key == "song_id" else a["artists"])})
+        return [rng.choice(ids) + rng.randrange(config.scale) * ID_STRIDE for _ in range(config.lookups)]
+
+    song_ids, album_ids, artist_ids = sample("song_id"), sample("album_id"), sample("artist_id")
+    cases = [
+        ("find_song", DB.find_song, song_ids),
+        ("find_album", DB.find_album, album_ids),
+        ("find_songs_by_album", DB.find_songs_by_album, album_ids),
+        ("find_songs_by_artist", DB.find_songs_by_artist, artist_ids),
+        ("avg_song_length", DB.avg_song_length, artist_ids),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        after = build(os.path.join(tmp, "after.sqlite3"), albums, config.scale)
+        before = build(os.path.join(tmp, "before.sqlite3"), albums, config.scale)
+        before.executescript(PRE_001)
+        rows = after.execute("SELECT count(*) FROM song_album").fetchone()[0]
+        print("%d albums, %d song_album rows, %d lookups per method (best of %d)"
+              % (len(albums) * config.scale, rows, config.lookups, config.repeat))
+        print("%-22s %12s %12s %8s" % ("method", "before (us)", "after (us)", "speedup"))
+        for name, method, ids in cases:
+            t_before = time_lookups(DB(before), method, ids, config.repeat)
+            t_after = time_lookups(DB(after), method, ids, config.repeat)
+            print("%-22s %12.1f %12.1f %7.1fx" % (name, t_before, t_after, t_before / t_after))
+        before.close()
+        after.close()
@@ -0,0 +1,138 @@
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Play event ingest rate and playcount query latency (DB.add_plays, top_song, top_country,
+# top_source).
+#
+# Builds a catalog from data/full (replicated --scale times, see lookups.py), writes
+# --plays synthetic events spread over --days days of one month through DB.add_plays,
+# then times each playcount query on random days and songs. For comparison the same
+# answers are also computed from the raw events of the monthly play table, which is what
+# the queries would cost without the daily rollups.
+#
+# Songs are drawn with a skewed popularity (the first songs of a shuffled list are played
+# far more than the rest, but every song gets plays); countries and sources from small
+# fixed lists.
+#
+# from the repository root:
+#   python3 bench/plays.py --plays 2000000 --scale 20
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from db import DB, EPOCH_ORDINAL  # noqa: E402
+from lookups import ALBUMS_FILE, ID_STRIDE, build  # noqa: E402
+from pool import DEFAULT_PRAGMAS  # noqa: E402
+
+COUNTRIES = ["US", "GB", "DE", "SE", "BR", "JP", "IN", "FR", "MX", "CA", "AU", "NG"]
+SOURCES = ["mobile", "web", "desktop", "radio", "smart_speaker"]
+FIRST_DAY = datetime.date(2024, 5, 1)
+POOL = 200000
+
+# the playcount queries answered from the raw events of the month, without the rollups
+RAW = {
+    "top_song": """SELECT song_id, song_name, count(*) AS play_count
+        FROM {table} JOIN song USING (song_id) WHERE played_at >= :start AND played_at < :end
+        GROUP BY song_id ORDER BY play_count DESC, song_id LIMIT 10""",
+    "top_country": """SELECT country, count(*) AS play_count
+        FROM {table} NATURAL JOIN play_country WHERE played_at >= :start AND played_at < :end
+        GROUP BY country ORDER BY play_count DESC, country LIMIT 10""",
+    "top_source": """SELECT source, count(*) AS play_count
+        FROM {table} NATURAL JOIN play_source
+        WHERE played_at >= :start AND played_at < :end AND song_id = :song_id
+        GROUP BY source ORDER BY play_count DESC, source""",
+}
+
+
+# count events, cycling through a pool of at most POOL distinct ones made up front so
+# that making them is not part of the time measured
+def events(song_ids, count, days, rng):
+    start = int(datetime.datetime.combine(FIRST_DAY, datetime.time(), datetime.timezone.utc).timestamp())
+    pool = []
+    for _ in range(min(count, POOL)):
+        song = song_ids[int(len(song_ids) * rng.random() ** 3)]
+        moment = datetime.datetime.fromtimestamp(start + rng.randrange(days * 86400), datetime.timezone.utc)
+        pool.append({"song_id": song, "played_at": moment.isoformat(),
+                     "country": rng.choice(COUNTRIES), "source": rng.choice(SOURCES)})
+    return itertools.islice(itertools.cycle(pool), count)
+
+
+# milliseconds per call of fn(*args) over cases, best of repeat runs
+def time_ms(fn, cases, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for args in cases:
+            fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000 / len(cases)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--plays", help="play events to write (default 1000000)", default=1000000, type=int)
+    parser.add_argument("--days", help="days the plays are spread over, at most 28 (default 28)", default=28, type=int)
+    parser.add_argument("--scale", help="copies of data/full in the catalog (default 10)", default=10, type=int)
+    parser.add_argument("--chunk-size", help="plays per transaction (default 5000)", default=5000, type=int)
+    parser.add_argument("--queries", help="calls per query (default 50)", default=50, type=int)
+    config = parser.parse_args()
+
+    with open(ALBUMS_FILE, "r") as f:
+        albums = json.load(f)["values"]
+    rng = random.Random(42)
+    base_ids = sorted({s["song_id"] for a in albums for s in a["songs"]})
+    song_ids = [i + k * ID_STRIDE for k in range(config.scale) for i in base_ids]
+    rng.shuffle(song_ids)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = build(os.path.join(tmp, "plays.sqlite3"), albums, config.scale)
+        # as the server's writer connection
+        for name, value in DEFAULT_PRAGMAS.items():
+            conn.execute("PRAGMA %s = %s" % (name, value))
+        db = DB(conn)
+        plays = events(song_ids, config.plays, config.days, rng)
+        start = time.perf_counter()
+        res = db.add_plays(plays, chunk_size=config.chunk_size)
+        seconds = time.perf_counter() - start
+        print("%d songs; %d plays over %d days written in %.1f s: %.0f plays/s (%d failed)"
+              % (len(song_ids), res["inserted"], config.days, seconds, res["inserted"] / seconds, res["failed"]))
+        table = "play_%04d%02d" % (FIRST_DAY.year, FIRST_DAY.month)
+        print("rows: %s %d, play_song_daily %d, play_source_daily %d" % (
+            table, conn.execute("SELECT count(*) FROM %s" % table).fetchone()[0],
+            conn.execute("SELECT count(*) FROM play_song_daily").fetchone()[0],
+            conn.execute("SELECT count(*) FROM play_source_daily").fetchone()[0]))
+
+        dates = [FIRST_DAY + datetime.timedelta(days=rng.randrange(config.days)) for _ in range(config.queries)]
+        popular = song_ids[:20]
+        cases = {
+            "top_song": [(d.isoformat(),) for d in dates],
+            "top_country": [(d.isoformat(),) for d in dates],
+            "top_source": [(rng.choice(popular), d.isoformat()) for d in dates],
+        }
+
+        def raw(name):
+            sql = RAW[name].format(table=table)
+
+            def run(*args):
+                day = datetime.date.fromisoformat(args[-1]).toordinal() - EPOCH_ORDINAL
+                params = {"start": day * 86400, "end": (day + 1) * 86400}
+                if len(args) == 2:
+                    params["song_id"] = args[0]
+                return conn.execute(sql, params).fetchall()
+            return run
+
+        print("%-12s %14s %14s" % ("query", "rollups (ms)", "raw scan (ms)"))
+        for name, args in cases.items():
+            t_rollup = time_ms(getattr(db, name), args)
+            t_raw = time_ms(raw(name), args[:5], repeat=1)
+            print("%-12s %14.3f %14.1f" % (name, t_rollup, t_raw))
+        conn.close()
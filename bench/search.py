@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+# /search (DB.search, the name_search FTS5 index) against the LIKE '%word%' scans people
+# ran through /web/query, and what keeping the index up to date costs album ingest.
+#
+# Loads data/full (replicated --scale times, see lookups.py) through DB.add_albums with
+# the name_search triggers of schema/create.sql and without them, then times both kinds of
+# search on words taken from the catalog's names (whole words, and their first three
+# letters as a prefix) and on words that are in no name. The LIKE scan matches a word
+# anywhere in a name, not just at the start of a word, and is not ranked: it stops at the
+# first --limit rows it finds, where the FTS5 query ranks every match. Each name is in the
+# catalog --scale times, so a word of the catalog has at least that many matches to rank.
+#
+# from the repository root:
+#   python3 bench/search.py --scale 20
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from db import DB  # noqa: E402
+from lookups import ALBUMS_FILE, CREATE_SQL, ID_STRIDE, shifted  # noqa: E402
+
+TRIGGERS = ("song_name_search", "album_name_search", "artist_name_search")
+
+LIKE = """SELECT 'song', song_id, song_name FROM song WHERE song_name LIKE :pattern
+    UNION ALL SELECT 'album', album_id, album_name FROM album WHERE album_name LIKE :pattern
+    UNION ALL SELECT 'artist', artist_id, artist_name FROM artist WHERE artist_name LIKE :pattern
+    LIMIT :n"""
+
+
+# loads albums into a new database at path and returns (connection, seconds spent in add_albums)
+def load(path, albums, indexed):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    with open(CREATE_SQL, "r") as f:
+        conn.executescript(f.read())
+    if not indexed:
+        for trigger in TRIGGERS:
+            conn.execute("DROP TRIGGER %s" % trigger)
+    db = DB(conn)
+    start = time.perf_counter()
+    db.add_albums(albums)
+    return conn, time.perf_counter() - start
+
+
+# milliseconds per call of fn(arg) over args, best of repeat runs
+def time_ms(fn, args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for arg in args:
+            fn(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000 / len(args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", help="copies of data/full to load (default 20)", default=20, type=int)
+    parser.add_argument("--queries", help="search words per kind of query (default 50)", default=50, type=int)
+    parser.add_argument("--limit", help="results per search (default 20)", default=20, type=int)
+    parser.add_argument("--rounds", help="loads of each kind, the fastest counts (default 3)", default=3, type=int)
+    config = parser.parse_args()
+
+    with open(ALBUMS_FILE, "r") as f:
+        albums = json.load(f)["values"]
+    copies = [shifted(a, k * ID_STRIDE) for k in range(config.scale) for a in albums]
+    names = [s["song_name"] for a in albums for s in a["songs"]] + [a["album_name"] for a in albums]
+    words = sorted({w.strip(",.()!?:").lower() for name in names for w in name.split()} - {""})
+    words = [w for w in words if len(w) >= 4]
+    rng = random.Random(42)
+    sample = [rng.choice(words) for _ in range(config.queries)]
+    missing = ["zq%05d" % rng.randrange(100000) for _ in range(config.queries)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # the two kinds of load take turns so that noise from the rest of the machine hits them alike
+        best = {}
+        for _ in range(config.rounds):
+            for indexed in (False, True):
+                conn, seconds = load(os.path.join(tmp, "catalog.sqlite3"), copies, indexed)
+                conn.close()
+                best[indexed] = min(best.get(indexed, seconds), seconds)
+        count = len(copies)
+        print("%d albums; add_albums %.1f us/album without the index, %.1f us/album with it (+%.0f%%)"
+              % (count, best[False] * 1e6 / count, best[True] * 1e6 / count, 100 * (best[True] / best[False] - 1)))
+
+        conn, _ = load(os.path.join(tmp, "catalog.sqlite3"), copies, True)
+        db = DB(conn)
+        rows = conn.execute("SELECT count(*) FROM name_search").fetchone()[0]
+        print("%d names indexed, %d words per kind of query, limit %d" % (rows, len(sample), config.limit))
+        print("%-16s %12s %12s %9s" % ("query", "FTS5 (ms)", "LIKE (ms)", "speedup"))
+        for label, terms in (("word", sample), ("3 letter prefix", [w[:3] for w in sample]), ("no match", missing)):
+            t_fts = time_ms(lambda q: db.search(q, config.limit), terms)
+            t_like = time_ms(lambda q: conn.execute(LIKE, {"pattern": "%" + q + "%", "n": config.limit}).fetchall(),
+                             terms)
+            print("%-16s %12.3f %12.3f %8.1fx" % (label, t_fts, t_like, t_like / t_fts))
+        conn.close()
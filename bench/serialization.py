@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Cost of turning find_songs_by_artist results into the JSON response body:
+#   to_json     rows -> to_json dicts, artist_ids added per dict, then encoded like jsonify
+#   dicts       find_songs_by_artist (one dict per song), then encoded like jsonify
+#   template    find_songs_by_artist_json (rows encoded by db.SONG_ROW)
+# Each variant is timed end to end (query included) for every artist, and the encoding
+# step alone on rows fetched beforehand. The bodies are checked to be identical first.
+# Last, both DB paths are timed on cache hits: cached dicts still have to be encoded on
+# every request, the JSON text is sent as is.
+#
+# from the repository root:
+#   python3 bench/serialization.py --scale 5
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from cache import LRUCache  # noqa: E402
+from db import DB, SONG_ROW, to_json  # noqa: E402
+from lookups import ALBUMS_FILE, build  # noqa: E402
+
+
+# what flask.jsonify does with a list of dicts (sort_keys, compact, ASCII)
+def jsonify_text(res):
+    return json.dumps(res, sort_keys=True, separators=(",", ":"))
+
+
+def with_to_json(db, artist_id):
+    c = db.conn.cursor()
+    c.execute("""SELECT song_id, song_name, length FROM song NATURAL JOIN song_artist
+        WHERE artist_id = ? ORDER BY song_id""", (artist_id,))
+    res = to_json(c)
+    c.execute("""SELECT sa.song_id, other.artist_id FROM song_artist AS sa
+        JOIN song_artist AS other ON other.song_id = sa.song_id
+        WHERE sa.artist_id = ? ORDER BY sa.song_id, other.artist_id""", (artist_id,))
+    artist_ids = {}
+    for song_id, other in c:
+        artist_ids.setdefault(song_id, []).append(other)
+    for song in res:
+        song["artist_ids"] = artist_ids[song["song_id"]]
+    return jsonify_text(res)
+
+
+def with_dicts(db, artist_id):
+    return jsonify_text(db.find_songs_by_artist(artist_id))
+
+
+def with_template(db, artist_id):
+    return db.find_songs_by_artist_json(artist_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", help="copies of data/full to load (default 1)", default=1, type=int)
+    parser.add_argument("--repeat", help="runs per variant, best is kept (default 5)", default=5, type=int)
+    config = parser.parse_args()
+
+    with open(ALBUMS_FILE, "r") as f:
+        albums = json.load(f)["values"]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = build(os.path.join(tmp, "bench.sqlite3"), albums, config.scale)
+        db = DB(conn)
+        artist_ids = [row[0] for row in conn.execute("SELECT DISTINCT artist_id FROM song_artist ORDER BY 1")]
+        songs = conn.execute("SELECT count(*) FROM song_artist").fetchone()[0]
+        variants = [("to_json", with_to_json), ("dicts", with_dicts), ("template", with_template)]
+        for artist_id in artist_ids:
+            bodies = {v(db, artist_id) for name, v in variants}
+            assert len(bodies) == 1, "variants disagree for artist %s" % artist_id
+
+        print("%d artists, %d (song, artist) rows, best of %d" % (len(artist_ids), songs, config.repeat))
+        print("%-10s %16s %18s" % ("variant", "end to end (us)", "encode only (us)"))
+
+        # rows as each variant has them right before encoding
+        headers = ("song_id", "song_name", "length")
+        fetched = [[song for song_id, song in db.iter_songs_by_artist(a)] for a in artist_ids]
+        encoders = {
+            "to_json": lambda rows: jsonify_text([dict(dict(zip(headers, r[:3])), artist_ids=r[3]) for r in rows]),
+            "dicts": lambda rows: jsonify_text([SONG_ROW.to_dict(r) for r in rows]),
+            "template": SONG_ROW.encode_list,
+        }
+
+        def best_of(fn, items):
+            best = None
+            for _ in range(config.repeat):
+                start = time.perf_counter()
+                for item in items:
+                    fn(item)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            return best / len(items) * 1e6
+
+        for name, variant in variants:
+            end_to_end = best_of(lambda a: variant(db, a), artist_ids)
+            encode_only = best_of(encoders[name], fetched)
+            print("%-10s %16.1f %18.1f" % (name, end_to_end, encode_only))
+
+        cached = DB(conn, LRUCache(len(artist_ids) * 2))
+        for name, variant in variants[1:]:
+            for a in artist_ids:
+                variant(cached, a)
+            print("%-10s %16.1f   (cache hit)" % (name, best_of(lambda a: variant(cached, a), artist_ids)))
+        conn.close()
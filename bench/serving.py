@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# Throughput and latency of the Flask (WSGI) server against the ASGI entry point
+# (server/asgi.py, served by bench/asgi_server.py) as the number of concurrent clients grows.
+#
+# Builds a database from data/full (replicated --scale times, see lookups.py), starts
+# both servers on it, then for each concurrency level sends --requests GETs spread over
+# /songs, /albums, /artists and /songs/by_artist with random ids, through client.py's
+# Driver (one keep-alive session per client thread). The lookup cache is off unless
+# --cache is given, so every request reaches SQLite.
+#
+# The clients are Python threads in this process, so at high concurrency the load
+# generator itself is part of what is measured; compare the two columns, not the
+# absolute numbers.
+#
+# from the repository root:
+#   python3 bench/serving.py --concurrency 1 4 16 64
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(ROOT, "server")
+sys.path.insert(0, os.path.join(ROOT, "client"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from client import Driver, percentile  # noqa: E402
+from lookups import ALBUMS_FILE, ID_STRIDE, build  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# starts a server process in workdir (where its splatDB.sqlite3 is) and waits until it answers
+def start(name, port, workdir, cache):
+    env = dict(os.environ, PYTHONPATH=SERVER, FLASK_APP=os.path.join(SERVER, "app.py"),
+               SPLATIFY_CACHE_SIZE=str(10000 if cache else 0), SPLATIFY_SLOW_QUERY_MS="null")
+    if name == "wsgi":
+        cmd = [sys.executable, "-m", "flask", "run", "--port", str(port), "--with-threads"]
+    else:
+        cmd = [sys.executable, os.path.join(ROOT, "bench", "asgi_server.py"), "--port", str(port)]
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("%s server did not start" % name)
+
+
+# the request paths of one run, the same for both servers
+def workload(albums, scale, count, rng):
+    def pick(key):
+        return rng.choice(ids[key]) + rng.randrange(scale) * ID_STRIDE
+    ids = {
+        "song": [s["song_id"] for a in albums for s in a["songs"]],
+        "album": [a["album_id"] for a in albums],
+        "artist": [artist["artist_id"] for a in albums for artist in a["artists"]],
+    }
+    paths = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            paths.append("songs/%d" % pick("song"))
+        elif kind == 1:
+            paths.append("albums/%d" % pick("album"))
+        elif kind == 2:
+            paths.append("artists/%d" % pick("artist"))
+        else:
+            paths.append("songs/by_artist/%d" % pick("artist"))
+    return paths
+
+
+def run(port, paths, concurrency):
+    base = "http://127.0.0.1:%d/" % port
+    driver = Driver(concurrency)
+    # one request per client first, so connection setup is not timed
+    driver.map(lambda path: driver.session().get(base + path), paths[:concurrency])
+    start_time = time.perf_counter()
+    responses = driver.map(lambda path: driver.request("GET", base + path, path.rsplit("/", 1)[0], None, 200),
+                           paths)
+    elapsed = time.perf_counter() - start_time
+    driver.close()
+    ms = sorted(1000 * s.seconds for s in driver.samples)
+    errors = sum(1 for r in responses if r.status_code != 200)
+    return {"rps": len(paths) / elapsed, "p50": percentile(ms, 50), "p99": percentile(ms, 99), "errors": errors}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", help="copies of data/full to load (default 5)", default=5, type=int)
+    parser.add_argument("--requests", help="requests per concurrency level (default 2000)", default=2000, type=int)
+    parser.add_argument("--concurrency", help="client counts to run (default 1 4 16 64)",
+                        default=[1, 4, 16, 64], type=int, nargs="+")
+    parser.add_argument("--cache", help="keep the lookup cache on", action="store_true")
+    config = parser.parse_args()
+
+    with open(ALBUMS_FILE, "r") as f:
+        albums = json.load(f)["values"]
+    rng = random.Random(42)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        build(os.path.join(tmp, "splatDB.sqlite3"), albums, config.scale).close()
+        ports = {"wsgi": free_port(), "asgi": free_port()}
+        procs = [start(name, port, tmp, config.cache) for name, port in ports.items()]
+        try:
+            print("%d albums, %d requests per level, cache %s"
+                  % (len(albums) * config.scale, config.requests, "on" if config.cache else "off"))
+            print("%11s | %24s | %24s" % ("", "WSGI (flask run)", "ASGI (asgi.py)"))
+            print("%11s | %8s %7s %7s | %8s %7s %7s" % ("concurrency", "req/s", "p50 ms", "p99 ms",
+                                                        "req/s", "p50 ms", "p99 ms"))
+            for concurrency in config.concurrency:
+                paths = workload(albums, config.scale, config.requests, rng)
+                res = {name: run(port, paths, concurrency) for name, port in ports.items()}
+                print("%11d | %8.0f %7.2f %7.2f | %8.0f %7.2f %7.2f" % (
+                    concurrency, res["wsgi"]["rps"], res["wsgi"]["p50"], res["wsgi"]["p99"],
+                    res["asgi"]["rps"], res["asgi"]["p50"], res["asgi"]["p99"]))
+                for name in ports:
+                    if res[name]["errors"]:
+                        print("  %s: %d requests did not return 200" % (name, res[name]["errors"]))
+        finally:
+            for proc in procs:
+                proc.terminate()
+                proc.wait()
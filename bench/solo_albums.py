@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+# /analytics/solo_albums from the album.solo flag against computing it on every request,
+# and what keeping the flag up to date costs album ingest.
+#
+# Loads data/full (replicated --scale times, see lookups.py) through DB.add_albums with the
+# flag maintained after each album (as the server does) and without it, then times
+# DB.solo_albums (the album_solo partial index) against the same answer from comparing the
+# artists of every album with those of its songs (queries.SOLO as a filter over the whole
+# album table).
+#
+# from the repository root:
+#   python3 bench/solo_albums.py --scale 20
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from db import DB  # noqa: E402
+from lookups import ALBUMS_FILE, CREATE_SQL, ID_STRIDE, shifted  # noqa: E402
+from queries import SOLO  # noqa: E402
+
+NAIVE = "SELECT album_id, album_name, release_year FROM album WHERE %s ORDER BY album_id" % SOLO
+
+
+# loads albums into a new database at path and returns (connection, seconds spent in add_albums)
+def load(path, albums, maintain):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    with open(CREATE_SQL, "r") as f:
+        conn.executescript(f.read())
+    db = DB(conn)
+    db.defer_solo = not maintain
+    start = time.perf_counter()
+    db.add_albums(albums)
+    return conn, time.perf_counter() - start
+
+
+# milliseconds per call of fn(), best of repeat runs of calls calls
+def time_ms(fn, calls, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000 / calls
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", help="copies of data/full to load (default 20)", default=20, type=int)
+    parser.add_argument("--calls", help="calls per query (default 20)", default=20, type=int)
+    parser.add_argument("--rounds", help="loads of each kind, the fastest counts (default 5)", default=5, type=int)
+    config = parser.parse_args()
+
+    with open(ALBUMS_FILE, "r") as f:
+        albums = json.load(f)["values"]
+    copies = [shifted(a, k * ID_STRIDE) for k in range(config.scale) for a in albums]
+    count = len(copies)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # the two kinds of load take turns so that noise from the rest of the machine hits them alike
+        best = {}
+        for _ in range(config.rounds):
+            for maintain in (False, True):
+                conn, seconds = load(os.path.join(tmp, "catalog.sqlite3"), copies, maintain)
+                conn.close()
+                best[maintain] = min(best.get(maintain, seconds), seconds)
+        t_plain, t_solo = best[False], best[True]
+        print("%d albums; add_albums %.1f us/album without the flag, %.1f us/album with it (+%.0f%%)"
+              % (count, t_plain * 1e6 / count, t_solo * 1e6 / count, 100 * (t_solo / t_plain - 1)))
+        conn, _ = load(os.path.join(tmp, "catalog.sqlite3"), copies, True)
+
+        db = DB(conn)
+        flagged = [row["album_id"] for row in db.solo_albums()]
+        computed = [row[0] for row in conn.execute(NAIVE)]
+        assert flagged == computed
+        t_flag = time_ms(db.solo_albums, config.calls)
+        t_naive = time_ms(lambda: conn.execute(NAIVE).fetchall(), config.calls)
+        print("%d solo albums" % len(flagged))
+        print("%-34s %10.3f ms" % ("solo_albums (album_solo index)", t_flag))
+        print("%-34s %10.3f ms" % ("computed over every album", t_naive))
+        print("speedup %.0fx" % (t_naive / t_flag))
+        conn.close()
@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+# Cost per album of validating an album post and collecting its rows: db.parse_album
+# against the checks it replaced (previous_parse_album below: exact key sets of songs and
+# top level artists built with set(), then a second pass collecting the rows), on the
+# albums of data/50album/add-50album.json. "rows only" collects the rows with no checks at
+# all; what each parser costs above it is what its validation costs.
+#
+# The previous checks did not look at the artists of songs or at any value type, so the
+# current validator does more work per album; both are timed on valid albums, where
+# neither reports anything.
+#
+# from the repository root:
+#   python3 bench/validation.py --repeat 500
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "server"))
+
+from db import BadRequest, parse_album  # noqa: E402
+
+ALBUMS_FILE = os.path.join(ROOT, "data", "50album", "add-50album.json")
+
+
+def previous_album_rows(album_id, album_name, release_year, artists, songs):
+    rows = {
+        "album": [(album_id, album_name, release_year)],
+        "artist": [],
+        "song": [],
+        "song_artist": [],
+        "song_album": [],
+        "artist_album": [],
+    }
+    for artist in artists:
+        rows["artist"].append((artist["artist_id"], artist["artist_name"], artist["country"]))
+        rows["artist_album"].append((artist["artist_id"], album_id))
+    artist_ids = {artist["artist_id"] for artist in artists}
+    for order_in_album, song in enumerate(songs, 1):
+        song_id = song["song_id"]
+        rows["song"].append((song_id, song["song_name"], song["length"]))
+        for artist in song["artists"]:
+            rows["song_artist"].append((song_id, artist["artist_id"]))
+            if artist["artist_id"] not in artist_ids:
+                artist_ids.add(artist["artist_id"])
+                rows["artist"].append((artist["artist_id"], artist["artist_name"], artist["country"]))
+        rows["song_album"].append((song_id, album_id, order_in_album))
+    return rows
+
+
+def rows_only(post_body):
+    return previous_album_rows(post_body["album_id"], post_body["album_name"], post_body["release_year"],
+                               post_body["artists"], post_body["songs"])
+
+
+PREVIOUS_SONG_KEYS = {"song_id", "song_name", "length", "artists"}
+PREVIOUS_ARTIST_KEYS = {"artist_id", "artist_name", "country"}
+
+
+def previous_parse_album(post_body):
+    if not isinstance(post_body, dict):
+        raise BadRequest("album is not a JSON object")
+    try:
+        album_id = post_body["album_id"]
+        album_name = post_body["album_name"]
+        release_year = post_body["release_year"]
+        artists = post_body["artists"]
+        songs = post_body["songs"]
+    except KeyError:
+        raise BadRequest(message="Required attribute is missing")
+    if isinstance(songs, list) is False or isinstance(artists, list) is False:
+        raise BadRequest("song_ids or artist_ids are not lists")
+    if not all(set(song.keys()) == PREVIOUS_SONG_KEYS for song in songs):
+        raise BadRequest("bad song")
+    if not all(set(artist.keys()) == PREVIOUS_ARTIST_KEYS for artist in artists):
+        raise BadRequest("bad song")
+    return previous_album_rows(album_id, album_name, release_year, artists, songs)
+
+
+# microseconds per album of each parser (name -> function), best of `rounds` passes over
+# every album `repeat` times. The parsers take turns within each round so that noise from
+# the rest of the machine hits them alike
+def per_album_us(parsers, albums, repeat, rounds=15):
+    best = {}
+    for _ in range(rounds):
+        for name, parse in parsers.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for album in albums:
+                    parse(album)
+            elapsed = time.perf_counter() - start
+            best[name] = min(best.get(name, elapsed), elapsed)
+    return {name: seconds * 1e6 / (repeat * len(albums)) for name, seconds in best.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", help="passes over the albums per round (default 500)", default=500, type=int)
+    config = parser.parse_args()
+
+    with open(ALBUMS_FILE, "r") as f:
+        albums = json.load(f)["values"]
+    # both must agree on the rows before their speed is worth comparing
+    for album in albums:
+        assert parse_album(album) == previous_parse_album(album), album["album_id"]
+
+    songs = sum(len(a["songs"]) for a in albums)
+    print("%d albums, %.1f songs per album" % (len(albums), songs / len(albums)))
+    res = per_album_us({"rows": rows_only, "before": previous_parse_album, "after": parse_album},
+                       albums, config.repeat)
+    rows, before, after = res["rows"], res["before"], res["after"]
+    print("%-32s %8s %18s" % ("", "us/album", "us above rows only"))
+    print("%-32s %8.2f" % ("rows only (no checks)", rows))
+    print("%-32s %8.2f %18.2f" % ("previous (set() per object)", before, before - rows))
+    print("%-32s %8.2f %18.2f" % ("parse_album (compiled schema)", after, after - rows))
+    print("speedup %.2fx overall, %.2fx on validation" % (before / after, (before - rows) / (after - rows)))
@@ -1,9 +1,14 @@
 import json
 import argparse
+import math
 import sys
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError, ConnectTimeout
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from os import path
 
 
@@ -45,16 +50,61 @@ def validate_script(script_file):
                                           % (test_file, test_file_json.keys()))
 
 
+# One request sent by the Driver. path is the post_path/get_path (or url) of the script
+# entry it came from, so latencies can be grouped per endpoint. expected is the status
+# code the script expects (None if unknown)
+Sample = namedtuple("Sample", ["method", "path", "url", "status", "seconds", "expected"])
+
+
+# Sends requests over persistent keep-alive sessions (one per worker thread), up to
+# `concurrency` at a time, and records the latency of every request in samples
+class Driver:
+    def __init__(self, concurrency=1):
+        self.concurrency = concurrency
+        self.samples = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(concurrency) if concurrency > 1 else None
+
+    def session(self):
+        s = getattr(self._local, "session", None)
+        if s is None:
+            s = self._local.session = requests.Session()
+            s.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        return s
+
+    def request(self, method, url, path=None, body=None, expected=None):
+        start = time.perf_counter()
+        r = self.session().request(method, url, json=body)
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self.samples.append(Sample(method, path or url, url, r.status_code, seconds, expected))
+        return r
+
+    # applies fn to every item, concurrently when concurrency > 1. results keep the order of items
+    def map(self, fn, items):
+        if self._executor is None:
+            return [fn(item) for item in items]
+        return list(self._executor.map(fn, items))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
 # Run a single file which is made up of multiple requests to the same URL
-def run_test_file(server, test_file_path, fail_on_wrong_response=True):        
+# Requests of a file are sent through driver (possibly concurrently), then checked in file order
+def run_test_file(server, test_file_path, fail_on_wrong_response=True, driver=None):
+    driver = driver or Driver()
     with open(test_file_path, 'r') as test_file:
         script = json.load(test_file)
         response = script["response"]
         if "post_path" in script:
             count = 0
             post_url = "%s%s" % (server, script["post_path"])
-            for v in script["values"]:
-                r = requests.post(post_url, json=v)
+            responses = driver.map(lambda v: driver.request("POST", post_url, script["post_path"], v, response),
+                                   script["values"])
+            for v, r in zip(script["values"], responses):
                 if r.status_code != response:
                     if fail_on_wrong_response:
                         raise LoaderError("Failure (%s) on post to %s with value: %s. Body: %s "
@@ -64,16 +114,19 @@ def run_test_file(server, test_file_path, fail_on_wrong_response=True):
         elif "get_path" in script:
             count = 0
             get_urlbase = "%s%s" % (server, script["get_path"])
+            get_urls = []
             for v in script["tests"]:
                 if "inputs" in v:
                     inputs = v["inputs"]
-                    get_url = "%s/%s" % (get_urlbase, str(inputs))
+                    get_urls.append("%s/%s" % (get_urlbase, str(inputs)))
                 else:
-                    get_url = get_urlbase
+                    get_urls.append(get_urlbase)
+            responses = driver.map(lambda url: driver.request("GET", url, script["get_path"], None, response),
+                                   get_urls)
+            for v, get_url, r in zip(script["tests"], get_urls, responses):
                 # appending parameters into get_url
                 expected = v["expected"]
 
-                r = requests.get(get_url)
                 if r.status_code != response:
                     if fail_on_wrong_response:
                         raise LoaderError("Failure (%s) on get to %s  " % (r.status_code, get_url))
@@ -106,20 +159,129 @@ def run_script(script_file, cfg):
     print("Running script %s" % script_file)
     server = "http://%s:%s/" % (cfg.server, cfg.port)
     script_dir = path.dirname(script_file)
+    driver = Driver(cfg.concurrency)
+    start = time.perf_counter()
+    try:
+        with open(script_file, 'r') as file_in:
+            json_script = json.load(file_in)
+            for script in json_script:
+                if "url" in script:
+                    get_url = "%s%s" %(server,script["url"])
+                    r = driver.request("GET", get_url, script["url"], None, script["response"])
+                    if r.status_code != script["response"]:
+                        raise LoaderError("Failure on %s. Expected %s Got %s" % (get_url, script["response"], r.status_code))
+                    else:
+                        print("Called %s" % get_url)
+                else:
+                    first = len(driver.samples)
+                    count = run_test_file(server, path.join(script_dir, script["file"]), driver=driver)
+                    latencies = [sample.seconds for sample in driver.samples[first:]]
+                    print("Ran file %s Successful %s (%d requests, mean %.1f ms, max %.1f ms)"
+                          % (script["file"], count, len(latencies),
+                             1000 * sum(latencies) / max(len(latencies), 1), 1000 * max(latencies or [0])))
+    finally:
+        driver.close()
+    print("Done in %.2f s (%d requests, concurrency %d)"
+          % (time.perf_counter() - start, len(driver.samples), cfg.concurrency))
+    return driver.samples
+
+
+# Loads a script file for replay as a list of steps, one per script entry. A step is a list of
+# requests (method, url, path, body, expected status), the arguments of Driver.request.
+# Steps are sent in order, the requests of a step concurrently. Response bodies are not checked
+def load_steps(script_file, server):
+    script_dir = path.dirname(script_file)
+    steps = []
     with open(script_file, 'r') as file_in:
-        json_script = json.load(file_in)
-        for script in json_script:
+        for script in json.load(file_in):
             if "url" in script:
-                get_url = "%s%s" %(server,script["url"])
-                r = requests.get(get_url)
-                if r.status_code != script["response"]:
-                    raise LoaderError("Failure on %s. Expected %s Got %s" % (get_url, script["response"], r.status_code))
-                else:
-                    print("Called %s" % get_url)
+                steps.append([("GET", server + script["url"], script["url"], None, script["response"])])
+                continue
+            with open(path.join(script_dir, script["file"]), 'r') as test_file:
+                test = json.load(test_file)
+            if "post_path" in test:
+                url = server + test["post_path"]
+                steps.append([("POST", url, test["post_path"], v, test["response"]) for v in test["values"]])
             else:
-                count = run_test_file(server, path.join(script_dir, script["file"]))
-                print("Ran file %s Successful %s" % (script["file"], count))
-    print("Done")
+                url = server + test["get_path"]
+                steps.append([("GET", "%s/%s" % (url, t["inputs"]) if "inputs" in t else url, test["get_path"],
+                               None, test["response"]) for t in test["tests"]])
+    return steps
+
+
+# nearest-rank percentile of a sorted list
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    rank = max(math.ceil(pct / 100.0 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+# Summary of samples per "METHOD path", latencies in ms
+def summarize(samples, elapsed):
+    by_endpoint = defaultdict(list)
+    for sample in samples:
+        by_endpoint["%s %s" % (sample.method, sample.path)].append(sample)
+    endpoints = {}
+    for name, group in sorted(by_endpoint.items()):
+        ms = sorted(1000 * sample.seconds for sample in group)
+        endpoints[name] = {
+            "count": len(group),
+            "errors": sum(1 for sample in group if sample.expected is not None and sample.status != sample.expected),
+            "throughput_rps": round(len(group) / elapsed, 2),
+            "mean_ms": round(sum(ms) / len(ms), 3),
+            "p50_ms": round(percentile(ms, 50), 3),
+            "p95_ms": round(percentile(ms, 95), 3),
+            "p99_ms": round(percentile(ms, 99), 3),
+            "max_ms": round(ms[-1], 3),
+        }
+    return endpoints
+
+
+# Replays the script for cfg.iterations runs, or for cfg.duration seconds, and reports
+# throughput and latency percentiles per endpoint. Returns the JSON summary
+def run_benchmark(script_file, cfg):
+    server = "http://%s:%s/" % (cfg.server, cfg.port)
+    steps = load_steps(script_file, server)
+    driver = Driver(cfg.concurrency)
+    iterations = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            for step in steps:
+                driver.map(lambda req: driver.request(*req), step)
+            iterations += 1
+            elapsed = time.perf_counter() - start
+            if cfg.duration:
+                if elapsed >= cfg.duration:
+                    break
+            elif iterations >= cfg.iterations:
+                break
+    except (ConnectionError, ConnectTimeout) as e:
+        raise LoaderError("Could not reach %s: %s" % (server, e))
+    finally:
+        driver.close()
+    elapsed = time.perf_counter() - start
+
+    summary = {
+        "script": script_file,
+        "concurrency": cfg.concurrency,
+        "iterations": iterations,
+        "elapsed_s": round(elapsed, 3),
+        "requests": len(driver.samples),
+        "throughput_rps": round(len(driver.samples) / elapsed, 2),
+        "endpoints": summarize(driver.samples, elapsed),
+    }
+    print("%d iterations of %s in %.2f s: %d requests, %.1f req/s (concurrency %d)"
+          % (iterations, script_file, elapsed, len(driver.samples), summary["throughput_rps"], cfg.concurrency))
+    print("%-42s %7s %6s %9s %9s %9s %9s" % ("endpoint", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for name, e in summary["endpoints"].items():
+        print("%-42s %7d %6d %9.1f %9.2f %9.2f %9.2f"
+              % (name, e["count"], e["errors"], e["throughput_rps"], e["p50_ms"], e["p95_ms"], e["p99_ms"]))
+    if cfg.json_out:
+        with open(cfg.json_out, 'w') as out:
+            json.dump(summary, out, indent=2)
+    return summary
 
 
 if __name__ == "__main__":
@@ -128,10 +290,18 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--server", help="Server hostname (default localhost)", default="localhost")
     parser.add_argument("-p", "--port", help="Server port (default 5000)", default=5000, type=int)
     parser.add_argument("-i", "--indent", help="indent compare output (default False)", default=False, action="store_true")
+    parser.add_argument("-c", "--concurrency", help="requests in flight at once within a file (default 1)", default=1, type=int)
+    parser.add_argument("-b", "--bench", help="replay the script as a benchmark instead of checking responses", default=False, action="store_true")
+    parser.add_argument("-n", "--iterations", help="benchmark: times to replay the script (default 1)", default=1, type=int)
+    parser.add_argument("-d", "--duration", help="benchmark: replay for this many seconds instead of -n times", default=None, type=float)
+    parser.add_argument("-o", "--json-out", help="benchmark: write the JSON summary to this file", default=None)
 
     config = parser.parse_args()
     try:
         validate_script(config.file)
-        run_script(config.file, config)
+        if config.bench:
+            run_benchmark(config.file, config)
+        else:
+            run_script(config.file, config)
     except LoaderError as e:
         print("LoaderError: %s" % e.message)
@@ -1,10 +1,19 @@
-from flask import current_app, g, Flask, flash, jsonify, redirect, render_template, request, session, Response
+from flask import current_app, g, Flask, flash, jsonify, redirect, render_template, request, session, Response, stream_with_context, stream_template
 import logging
 import sqlite3
 import json
-import requests
-from db import DB, KeyNotFound, BadRequest
+from db import DB, KeyNotFound, BadRequest, SONG_ROW, ALBUM_ROW, parse_album, parse_ids
+from ingest import IngestQueue, QueueFull
+from jsonstream import JSONDocs, iter_json_docs
+from pool import ConnectionPool
+from cache import LRUCache
+from slowlog import SlowQueryLog, file_logger
+from queries import QUERIES
+import metrics
 import datetime
+from werkzeug.exceptions import HTTPException
+import threading
+import time
 
 # how to set the logging level
 logging.basicConfig(level=logging.ERROR)
@@ -25,6 +34,62 @@ app.secret_key = b'mEw6%7APK'
 # path to database
 DATABASE = 'splatDB.sqlite3'
 
+# database connection pool (see pool.py). DB_CACHE_KB is the page cache of each connection
+app.config['DB_POOL_SIZE'] = 8
+app.config['DB_POOL_TIMEOUT'] = 5.0
+app.config['DB_CACHE_KB'] = 64 * 1024
+app.config['DB_MMAP_SIZE'] = 256 * 1024 * 1024
+
+# lookup result cache (see cache.py). CACHE_SIZE = 0 turns it off, CACHE_TTL is in seconds
+app.config['CACHE_SIZE'] = 10000
+app.config['CACHE_TTL'] = None
+
+# number of albums committed per transaction by /albums/bulk (override with ?chunk_size=)
+app.config['BULK_CHUNK_SIZE'] = 500
+
+# number of play events committed per transaction by POST /plays (override with ?chunk_size=)
+app.config['PLAYS_CHUNK_SIZE'] = 5000
+
+# with INGEST_QUEUE on, POST /album only validates and queues the album, answers 202 with a
+# job id, and a writer thread commits queued albums INGEST_BATCH_SIZE at a time (see ingest.py).
+# /album/jobs/<job_id> tells when it is written
+app.config['INGEST_QUEUE'] = False
+app.config['INGEST_BATCH_SIZE'] = 100
+app.config['INGEST_BATCH_WAIT'] = 0.005
+app.config['INGEST_MAX_QUEUED'] = 10000
+
+# request and SQL statement timing for /metrics and /queries/stats (see metrics.py).
+# when off the only cost left is one config lookup per request
+app.config['METRICS_ENABLED'] = True
+
+# statements taking SLOW_QUERY_MS or longer are logged with their plan to SLOW_QUERY_LOG,
+# which rolls over every SLOW_QUERY_LOG_BYTES keeping SLOW_QUERY_LOG_BACKUPS old files
+# (see slowlog.py). SLOW_QUERY_MS = None turns it off
+app.config['SLOW_QUERY_MS'] = 100
+app.config['SLOW_QUERY_LOG'] = 'slow_queries.log'
+app.config['SLOW_QUERY_LOG_BYTES'] = 10 * 1024 * 1024
+app.config['SLOW_QUERY_LOG_BACKUPS'] = 5
+
+# most ids a batch lookup (/songs, /albums or /artists with ?ids=) takes
+app.config['BATCH_MAX_IDS'] = 500
+
+# results of /search when no ?limit= is given, and the most it returns
+app.config['SEARCH_LIMIT'] = 20
+app.config['SEARCH_MAX_LIMIT'] = 100
+
+# /web/query runs on its own WEB_QUERY_POOL_SIZE read only connections, so it never holds
+# the writer or a reader the API needs. A query is stopped after WEB_QUERY_TIMEOUT seconds
+# and the page shows at most WEB_QUERY_MAX_ROWS rows
+app.config['WEB_QUERY_POOL_SIZE'] = 2
+app.config['WEB_QUERY_TIMEOUT'] = 2.0
+app.config['WEB_QUERY_MAX_ROWS'] = 1000
+
+# any of the above can be set from the environment as SPLATIFY_<NAME>, the value being
+# parsed as JSON, eg SPLATIFY_CACHE_SIZE=0 or SPLATIFY_SLOW_QUERY_MS=null
+app.config.from_prefixed_env("SPLATIFY")
+
+QUERIES.enabled = app.config['METRICS_ENABLED']
+
 
 # default path
 @app.route('/')
@@ -53,7 +118,7 @@ def create_tables():
     """
     Drops existing tables and creates new tables
     """
-    db = DB(get_db_conn())
+    db = DB(get_db_writer(), get_cache(), get_slow_log())
     return db.create_db('schema/create.sql')
 
 
@@ -68,12 +133,123 @@ def add_album():
         logging.error("No post body")
         return Response(status=400)
 
-    # get DB class with new connection
-    db = DB(get_db_conn())
+    if app.config['INGEST_QUEUE']:
+        try:
+            job_id = queue_album(post_body)
+        except BadRequest as e:
+            raise InvalidUsage(e.message, status_code=e.error_code, payload=e.to_dict())
+        except QueueFull:
+            raise InvalidUsage("too many albums waiting to be written, retry later", status_code=503)
+        response = jsonify({"job_id": job_id, "status": "queued"})
+        response.status_code = 202
+        response.headers['Location'] = '/album/jobs/%s' % job_id
+        return response
+
+    # get DB class with the writer connection
+    db = DB(get_db_writer(), get_cache(), get_slow_log())
 
     try:
         resp = db.add_album(post_body)
         return resp, 201
+    except BadRequest as e:
+        # every problem with the album is listed in "errors"
+        raise InvalidUsage(e.message, status_code=e.error_code, payload=e.to_dict())
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+
+
+# Validates an album and queues it for the ingest writer thread (INGEST_QUEUE), for
+# POST /album and the web pages. Returns the job id.
+# raise BadRequest() if the album is malformed, QueueFull() if too many albums are waiting
+def queue_album(post_body):
+    return get_ingest_queue().submit(parse_album(post_body))
+
+
+@app.route('/album/jobs/<job_id>', methods=["GET"])
+def album_job(job_id):
+    """
+    Returns the status of a queued album post: queued, done or failed (with a message)
+    """
+    job = get_ingest_queue().status(job_id) if app.config['INGEST_QUEUE'] else None
+    if job is None:
+        raise InvalidUsage("Key/Id not found", status_code=404)
+    return jsonify(job)
+
+
+@app.route('/albums/bulk', methods=["POST"])
+def add_albums_bulk():
+    """
+    Loads many albums in one request. The body is either a JSON array of albums
+    or newline delimited JSON (one album per line), and is read as a stream.
+    Returns the number of albums inserted/failed and the reasons for the first failures.
+    A body that is not valid JSON gets 400; the albums read before the error stay inserted.
+    """
+    try:
+        chunk_size = int(request.args.get('chunk_size', app.config['BULK_CHUNK_SIZE']))
+    except ValueError:
+        raise InvalidUsage("chunk_size must be an integer")
+    if chunk_size < 1:
+        raise InvalidUsage("chunk_size must be positive")
+
+    # get DB class with the writer connection
+    db = DB(get_db_writer(), get_cache(), get_slow_log())
+
+    albums = JSONDocs(request.stream)
+    try:
+        res = db.add_albums(albums, chunk_size=chunk_size)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+    if albums.error is not None:
+        raise InvalidUsage(albums.error, payload=res)
+    if res["failed"] == 0:
+        return jsonify(res), 201
+    if res["inserted"] == 0:
+        raise InvalidUsage("no albums inserted", payload=res)
+    return jsonify(res), 200
+
+
+@app.route('/plays', methods=["POST"])
+def add_plays():
+    """
+    Records play events, {"song_id", "played_at", "country", "source"} each. The body is
+    either a JSON array of events or newline delimited JSON (one event per line), and is
+    read as a stream. Returns the number of events inserted/failed and the first failures.
+    """
+    chunk_size = _int_arg('chunk_size')
+    if chunk_size is None:
+        chunk_size = app.config['PLAYS_CHUNK_SIZE']
+    if chunk_size < 1:
+        raise InvalidUsage("chunk_size must be positive")
+
+    # get DB class with the writer connection
+    db = DB(get_db_writer(), get_cache(), get_slow_log())
+
+    try:
+        res = db.add_plays(iter_json_docs(request.stream), chunk_size=chunk_size)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+    if res["failed"] == 0:
+        return jsonify(res), 201
+    if res["inserted"] == 0:
+        raise InvalidUsage("no plays inserted", payload=res)
+    return jsonify(res), 200
+
+
+@app.route('/songs', methods=["GET"])
+def find_songs():
+    """
+    Returns the songs of ?ids= (comma separated, at most BATCH_MAX_IDS) keyed by id, each as
+    /songs/<song_id> has it, and the ids not found as "missing"
+    """
+    # get DB class with new connection
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
+
+    try:
+        song_ids = parse_ids(request.args.get('ids'), app.config['BATCH_MAX_IDS'])
+        return jsonify(db.find_songs(song_ids))
     except BadRequest as e:
         raise InvalidUsage(e.message, status_code=e.error_code)
     except sqlite3.Error as e:
@@ -87,7 +263,7 @@ def find_song(song_id):
     Returns a song's info
     """
     # get DB class with new connection
-    db = DB(get_db_conn())
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
 
     try:
         res = db.find_song(song_id)
@@ -105,13 +281,16 @@ def find_song(song_id):
 def find_songs_by_album(album_id):
     """
     Returns all an album's songs
+    Pages with ?limit=&after=<order_in_album>, streams with ?stream=1 (see list_args)
     """
     # get DB class with new connection
-    db = DB(get_db_conn())
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
     
+    after, limit, stream = list_args()
     try:
-        res = db.find_songs_by_album(album_id)
-        return jsonify(res)
+        if after is None and limit is None and not stream:
+            return json_response(db.find_songs_by_album_json(album_id))
+        return list_response(db.iter_songs_by_album(album_id, after, limit), SONG_ROW, limit, stream)
     except KeyNotFound as e:
         logging.error(e)
         raise InvalidUsage(e.message, status_code=404)
@@ -125,13 +304,16 @@ def find_songs_by_album(album_id):
 def find_songs_by_artist(artist_id):
     """
     Returns all an artists' songs
+    Pages with ?limit=&after=<song_id>, streams with ?stream=1 (see list_args)
     """
     # get DB class with new connection
-    db = DB(get_db_conn())
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
 
+    after, limit, stream = list_args()
     try:
-        res = db.find_songs_by_artist(artist_id)
-        return jsonify(res)
+        if after is None and limit is None and not stream:
+            return json_response(db.find_songs_by_artist_json(artist_id))
+        return list_response(db.iter_songs_by_artist(artist_id, after, limit), SONG_ROW, limit, stream)
     except KeyNotFound as e:
         logging.error(e)
         raise InvalidUsage(e.message, status_code=404)
@@ -141,13 +323,32 @@ def find_songs_by_artist(artist_id):
     return Response(status=400)
 
 
+@app.route('/albums', methods=["GET"])
+def find_albums():
+    """
+    Returns the albums of ?ids= (comma separated, at most BATCH_MAX_IDS) keyed by id, each as
+    /albums/<album_id> has it, and the ids not found as "missing"
+    """
+    # get DB class with new connection
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
+
+    try:
+        album_ids = parse_ids(request.args.get('ids'), app.config['BATCH_MAX_IDS'])
+        return jsonify(db.find_albums(album_ids))
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+
+
 @app.route('/albums/<album_id>', methods=["GET"])
 def find_album(album_id):
     """
     Returns a album's info
     """
     # get DB class with new connection
-    db = DB(get_db_conn())
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
 
     try:
         res = db.find_album(album_id)
@@ -161,17 +362,40 @@ def find_album(album_id):
     return Response(status=400)
 
 
+@app.route('/albums/<album_id>/full', methods=["GET"])
+def find_album_full(album_id):
+    """
+    Returns an album with its songs in order (with their artist_ids) and the details of
+    every artist on it, keyed by artist_id: what /albums/<album_id>, /songs/by_album/<album_id>
+    and /artists/<artist_id> for each artist return, in one response
+    """
+    # get DB class with new connection
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
+
+    try:
+        return jsonify(db.find_album_full(album_id))
+    except KeyNotFound as e:
+        logging.error(e)
+        raise InvalidUsage(e.message, status_code=404)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+
+
 @app.route('/albums/by_artist/<artist_id>', methods=["GET"])
 def find_album_by_artist(artist_id):
     """
-    Returns a album's info
+    Returns an artist's albums
+    Pages with ?limit=&after=<album_id>, streams with ?stream=1 (see list_args)
     """
     # get DB class with new connection
-    db = DB(get_db_conn())
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
 
+    after, limit, stream = list_args()
     try:
-        res = db.find_album_by_artist(artist_id)
-        return jsonify(res)
+        if after is None and limit is None and not stream:
+            return json_response(db.find_album_by_artist_json(artist_id))
+        return list_response(db.iter_albums_by_artist(artist_id, after, limit), ALBUM_ROW, limit, stream)
     except KeyNotFound as e:
         logging.error(e)
         raise InvalidUsage(e.message, status_code=404)
@@ -181,13 +405,32 @@ def find_album_by_artist(artist_id):
     return Response(status=400)
 
 
+@app.route('/artists', methods=["GET"])
+def find_artists():
+    """
+    Returns the artists of ?ids= (comma separated, at most BATCH_MAX_IDS) keyed by id, each as
+    /artists/<artist_id> has it, and the ids not found as "missing"
+    """
+    # get DB class with new connection
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
+
+    try:
+        artist_ids = parse_ids(request.args.get('ids'), app.config['BATCH_MAX_IDS'])
+        return jsonify(db.find_artists(artist_ids))
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+
+
 @app.route('/artists/<artist_id>', methods=["GET"])
 def find_artist(artist_id):
     """
     Returns a artist's info
     """
     # get DB class with new connection
-    db = DB(get_db_conn())
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
 
     try:
         res = db.find_artist(artist_id)
@@ -200,6 +443,58 @@ def find_artist(artist_id):
         raise InvalidUsage(str(e))
     return Response(status=400)
 
+@app.route('/search', methods=["GET"])
+def search():
+    """
+    Returns the songs, albums and artists whose name has every word of ?q= (as a word or
+    the start of one), best match first (kind, id, name).
+    ?limit= of them (default SEARCH_LIMIT, at most SEARCH_MAX_LIMIT)
+    """
+    limit = _int_arg('limit')
+    if limit is not None and limit < 1:
+        raise InvalidUsage("limit must be positive")
+    limit = min(limit or app.config['SEARCH_LIMIT'], app.config['SEARCH_MAX_LIMIT'])
+    # get DB class with new connection
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
+
+    try:
+        return jsonify(db.search(request.args.get('q'), limit))
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+
+
+@app.route('/cache/stats', methods=["GET"])
+def cache_stats():
+    """
+    Returns the lookup cache counters (size, hits, misses, evictions, invalidations)
+    """
+    cache = get_cache()
+    if cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(cache.stats(), enabled=True))
+
+@app.route('/queries/stats', methods=["GET"])
+def query_stats():
+    """
+    Returns the execution counters of every registered statement that has run
+    (calls, rows, total_ms, mean_ms, max_ms), see queries.py
+    """
+    return Response(json.dumps(QUERIES.stats()) + "\n", mimetype="application/json")
+
+@app.route('/metrics', methods=["GET"])
+def metrics_page():
+    """
+    Returns request latency per route, execution time per SQL statement and the
+    lookup cache counters in the Prometheus text format
+    """
+    if not app.config['METRICS_ENABLED']:
+        raise InvalidUsage("metrics are disabled", status_code=404)
+    return Response(metrics.render(get_cache()), content_type=metrics.CONTENT_TYPE)
+
+
 # -----------------
 # Analytics Endpoints
 # These JSON/REST api endpoints are used to run analysis
@@ -212,7 +507,7 @@ def avg_song_length(artist_id):
     Returns the average length of an artist's songs (artist_id, avg_length)
     """
     # get DB class with new connection
-    db = DB(get_db_conn())
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
 
     try:
         res = db.avg_song_length(artist_id)
@@ -233,11 +528,13 @@ def top_length(num_artists):
     (artist_id, total_length). 
     """
     # get DB class with new connection
-    db = DB(get_db_conn())
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
     
     try:
         res = db.top_length(num_artists)
         return jsonify(res)
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
     except KeyNotFound as e:
         logging.error(e)
         raise InvalidUsage(e.message, status_code=404)
@@ -247,6 +544,84 @@ def top_length(num_artists):
     return Response(status=400)
 
 
+@app.route('/analytics/solo_albums', methods=["GET"])
+def solo_albums():
+    """
+    Returns the albums with a single artist whose songs are all credited to that artist alone
+    (album_id, album_name, release_year)
+    """
+    # get DB class with new connection
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
+
+    try:
+        return jsonify(db.solo_albums())
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+
+
+@app.route('/analytics/playcount/top_song/<date>', methods=["GET"])
+def top_song(date):
+    """
+    Returns the songs played the most on date (YYYY-MM-DD), ?limit= of them (default 10)
+    (song_id, song_name, play_count)
+    """
+    limit = _int_arg('limit')
+    if limit is not None and limit < 1:
+        raise InvalidUsage("limit must be positive")
+    # get DB class with new connection
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
+
+    try:
+        return jsonify(db.top_song(date, limit or 10))
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+
+
+@app.route('/analytics/playcount/top_country/<date>', methods=["GET"])
+def top_country(date):
+    """
+    Returns the countries with the most plays on date (YYYY-MM-DD), ?limit= of them
+    (default 10) (country, play_count)
+    """
+    limit = _int_arg('limit')
+    if limit is not None and limit < 1:
+        raise InvalidUsage("limit must be positive")
+    # get DB class with new connection
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
+
+    try:
+        return jsonify(db.top_country(date, limit or 10))
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+
+
+@app.route('/analytics/playcount/top_source/<song_id>/<date>', methods=["GET"])
+def top_source(song_id, date):
+    """
+    Returns the plays of a song on date (YYYY-MM-DD) by source (source, play_count)
+    """
+    # get DB class with new connection
+    db = DB(get_db_conn(), get_cache(), get_slow_log())
+
+    try:
+        return jsonify(db.top_source(song_id, date))
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
+    except KeyNotFound as e:
+        logging.error(e)
+        raise InvalidUsage(e.message, status_code=404)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+
+
 # -----------------
 # Web APIs
 # These simply wrap requests from the website/browser and
@@ -260,24 +635,47 @@ def query():
     runs pasted in query
     """
 
+    if request.method != "POST":
+        return render_template("query.html", rows=None)
+    qry = request.form.get("query")
+    # Ensure query was submitted
+    if not qry:
+        return render_template("error.html", errmsg="No query given", errcode=400)
+
+    # note DO NOT EVER DO THIS NORMALLY (run SQL from a client/web directly)
+    # https://xkcd.com/327/
+    # it runs read only, with a time and row budget, on a connection of its own
+    try:
+        db = DB(get_sandbox_conn(), None, get_slow_log())
+        rows = db.run_sandboxed(str(qry), max_rows=app.config['WEB_QUERY_MAX_ROWS'],
+                                timeout=app.config['WEB_QUERY_TIMEOUT'])
+    except BadRequest as e:
+        return render_template("error.html", errmsg=e.message, errcode=400)
+    except sqlite3.Error as e:
+        logging.error(e)
+        return render_template("error.html", errmsg=str(e), errcode=400)
+
+    # rows are rendered into the page as they are read
+    return hold_connections(Response(stream_template("query.html", rows=rows)))
+
+@app.route('/web/search', methods=["GET", "POST"])
+def search_landing():
     data = None
     if request.method == "POST":
-        qry = request.form.get("query")
-        # Ensure query was submitted
-
-        # get DB class with new connection
-        db = DB(get_db_conn())
+        q = request.form.get("q")
+        if q is None or q.strip() == "":
+            flash("Must set key")
+            return render_template("search.html", data=data)
 
-        # note DO NOT EVER DO THIS NORMALLY (run SQL from a client/web directly)
-        # https://xkcd.com/327/
         try:
-            res = db.run_query(str(qry))
+            db = DB(get_db_conn(), get_cache(), get_slow_log())
+            data = db.search(q, app.config['SEARCH_MAX_LIMIT'])
+        except BadRequest as e:
+            return render_template("error.html", errmsg=e.message, errcode=400)
         except sqlite3.Error as e:
             logging.error(e)
             return render_template("error.html", errmsg=str(e), errcode=400)
-
-        data = res
-    return render_template("query.html", data=data)
+    return render_template("search.html", data=data)
 
 # paste in a query
 @app.route('/web/post_data', methods=["GET", "POST"])
@@ -293,35 +691,27 @@ def post_song_web():
             flash("Must set key")
             return render_template("post_data.html", data=data)
 
-        get_url = "http://127.0.0.1:5000/%s" % parameter
-        print("Making request to %s" % get_url)
-        # grab the response
-
-        j = json.loads(request.form.get("json_data").strip())
-        print("Json from form: %s" % j)
-        r = requests.post(get_url, json=j)
-        if r.status_code >= 400:
-            print("Error.  %s  Body: %s" % (r, r.content))
-            return render_template("error.html", errmsg=r.json(), errcode=r.status_code)
+        try:
+            j = json.loads(request.form.get("json_data").strip())
+        except ValueError as e:
+            return render_template("error.html", errmsg={"message": "Bad JSON: %s" % e}, errcode=400)
+        try:
+            call_api(parameter, post_body=j)
+        except InvalidUsage as e:
+            return render_template("error.html", errmsg=e.to_dict(), errcode=e.status_code)
 
-        else:
-            flash("Ran post command")
+        flash("Ran post command")
         return render_template("post_data.html", data=None)
     return render_template("post_data.html", data=None)
 
 @app.route('/web/create', methods=["GET"])
 def create_web():
-    get_url = "http://127.0.0.1:5000/create"
-    print("Making request to %s" % get_url)
-    # grab the response
-    r = requests.get(get_url)
-    if r.status_code >= 400:
-        print("Error.  %s  Body: %s" % (r, r.content))
-        return render_template("error.html", errmsg=r.json(), errcode=r.status_code)
-
-    else:
-        flash("Ran create command")
-        data = r.json()
+    try:
+        data = call_api("create")
+    except InvalidUsage as e:
+        return render_template("error.html", errmsg=e.to_dict(), errcode=e.status_code)
+
+    flash("Ran create command")
     return render_template("home.html", data=data)
 
 
@@ -336,16 +726,10 @@ def song_landing():
             flash("Must set key")
             return render_template("songs.html", data=data)
 
-        get_url = "http://127.0.0.1:5000/songs/" + path + parameter
-        print("Making request to %s" % get_url)
-        # grab the response
-        r = requests.get(get_url)
-        if r.status_code >= 400:
-            print("Error.  %s  Body: %s" % (r, r.content))
-            return render_template("error.html", errmsg=r.json(), errcode=r.status_code)
-
-        else:
-            data = r.json()
+        try:
+            data = call_api("songs/" + path + parameter)
+        except InvalidUsage as e:
+            return render_template("error.html", errmsg=e.to_dict(), errcode=e.status_code)
     return render_template("songs.html", data=data)
 
 
@@ -361,15 +745,10 @@ def artists_landing():
             flash("Must set key")
             return render_template("artists.html", data=data)
 
-        get_url = "http://127.0.0.1:5000/artists/" + path + parameter
-        # grab the response
-        r = requests.get(get_url)
-        if r.status_code >= 400:
-            print("Error.  %s  Body: %s" % (r, r.content))
-            return render_template("error.html", errmsg=r.json(), errcode=r.status_code)
-
-        else:
-            data = r.json()
+        try:
+            data = call_api("artists/" + path + parameter)
+        except InvalidUsage as e:
+            return render_template("error.html", errmsg=e.to_dict(), errcode=e.status_code)
     return render_template("artists.html", data=data)
 
 
@@ -385,14 +764,10 @@ def albums_landing():
             flash("Must set key")
             return render_template("albums.html", data=data)
 
-        get_url = "http://127.0.0.1:5000/albums/" + path + parameter
-        # grab the response
-        r = requests.get(get_url)
-        if r.status_code >= 400:
-            print("Error.  %s  Body: %s" % (r, r.content))
-            return render_template("error.html", errmsg=r.json(), errcode=r.status_code)
-        else:
-            data = r.json()
+        try:
+            data = call_api("albums/" + path + parameter)
+        except InvalidUsage as e:
+            return render_template("error.html", errmsg=e.to_dict(), errcode=e.status_code)
     return render_template("albums.html", data=data)
 
 
@@ -404,14 +779,14 @@ def analytics_landing():
         # Ensure path was submitted
 
         if path == "solo_albums":
-            get_url = "http://127.0.0.1:5000/analytics/" + path
+            api_path = "analytics/" + path
         elif path == "playcount/top_song/" or path == "playcount/top_country/":
             date = request.form.get("date")
             if date is None or date.strip() == "":
                 flash("Must set key")
                 return render_template("analytics.html", data=data)
 
-            get_url = "http://127.0.0.1:5000/analytics/" + path + date
+            api_path = "analytics/" + path + date
         elif path == "playcount/top_source/":
             parameter = request.form.get("parameter")
             if parameter is None or parameter.strip() == "":
@@ -421,40 +796,251 @@ def analytics_landing():
             if parameter2 is None or parameter2.strip() == "":
                 flash("Must set key")
                 return render_template("analytics.html", data=data)
-            get_url = "http://127.0.0.1:5000/analytics/" + path + parameter + '/' + parameter2
+            api_path = "analytics/" + path + parameter + '/' + parameter2
         else:
             parameter = request.form.get("parameter")
             if parameter is None or parameter.strip() == "":
                 flash("Must set key")
                 return render_template("analytics.html", data=data)
 
-            get_url = "http://127.0.0.1:5000/analytics/" + path + parameter
+            api_path = "analytics/" + path + parameter
 
-        # grab the response
-        print(get_url)
-        r = requests.get(get_url)
-        if r.status_code >= 400:
-            print("Error.  %s  Body: %s" % (r, r.content))
-            return render_template("error.html", errmsg=r.json(), errcode=r.status_code)
-
-        else:
-            data = r.json()
+        try:
+            data = call_api(api_path)
+        except InvalidUsage as e:
+            return render_template("error.html", errmsg=e.to_dict(), errcode=e.status_code)
     return render_template("analytics.html", data=data)
 
 
+# -----------------
+# In-process dispatch for the web pages
+# The /web pages call the JSON API through call_api, which resolves the path
+# with the app's own URL map and calls the DB method behind it directly,
+# instead of making an HTTP request back to this server.
+# -------------------
+
+# GET endpoints whose Flask endpoint name is that of a DB method taking the view arguments
+WEB_READS = {
+    'find_song', 'find_songs_by_album', 'find_songs_by_artist',
+    'find_album', 'find_album_by_artist', 'find_artist',
+    'avg_song_length', 'top_length', 'solo_albums',
+    'top_song', 'top_country', 'top_source',
+}
+
+
+def call_api(path, post_body=None):
+    """
+    Runs the JSON API endpoint at path (eg "songs/by_album/76") in-process and returns
+    its data. The request is a POST of post_body when given, a GET otherwise.
+    raise InvalidUsage() with the endpoint's error message and status code on failure
+    """
+    method = "GET" if post_body is None else "POST"
+    try:
+        endpoint, args = app.url_map.bind("localhost").match("/" + path.lstrip("/"), method=method)
+    except HTTPException as e:
+        raise InvalidUsage("No %s endpoint at /%s" % (method, path), status_code=e.code)
+
+    try:
+        if endpoint in WEB_READS:
+            db = DB(get_db_conn(), get_cache(), get_slow_log())
+            return getattr(db, endpoint)(*args.values())
+        if endpoint == 'create_tables':
+            db = DB(get_db_writer(), get_cache(), get_slow_log())
+            return json.loads(db.create_db('schema/create.sql'))
+        if endpoint == 'add_album':
+            # through the writer thread when there is one, like POST /album
+            if app.config['INGEST_QUEUE']:
+                return {"job_id": queue_album(post_body), "status": "queued"}
+            db = DB(get_db_writer(), get_cache(), get_slow_log())
+            return json.loads(db.add_album(post_body))
+        if endpoint == 'add_albums_bulk':
+            db = DB(get_db_writer(), get_cache(), get_slow_log())
+            albums = post_body if isinstance(post_body, list) else [post_body]
+            return db.add_albums(albums, chunk_size=app.config['BULK_CHUNK_SIZE'])
+    except KeyNotFound as e:
+        logging.error(e)
+        raise InvalidUsage(e.message, status_code=404)
+    except BadRequest as e:
+        raise InvalidUsage(e.message, status_code=e.error_code)
+    except QueueFull:
+        raise InvalidUsage("too many albums waiting to be written, retry later", status_code=503)
+    except sqlite3.Error as e:
+        logging.error(e)
+        raise InvalidUsage(str(e))
+    raise InvalidUsage("/%s is not available from the web pages" % path, status_code=404)
+
+
 # -----------------
 # Utilities / Errors
 # -------------------
 
-# gets connection to database
+# process-wide connection pool, created on first use
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(DATABASE,
+                                   size=app.config['DB_POOL_SIZE'],
+                                   timeout=app.config['DB_POOL_TIMEOUT'],
+                                   pragmas={"cache_size": -app.config['DB_CACHE_KB'],
+                                            "mmap_size": app.config['DB_MMAP_SIZE']})
+    return _pool
+
+
+# read only connections for /web/query, created on first use
+_sandbox_pool = None
+
+
+def get_sandbox_pool():
+    global _sandbox_pool
+    with _pool_lock:
+        if _sandbox_pool is None:
+            _sandbox_pool = ConnectionPool(DATABASE,
+                                           size=app.config['WEB_QUERY_POOL_SIZE'],
+                                           timeout=app.config['DB_POOL_TIMEOUT'],
+                                           read_only=True)
+    return _sandbox_pool
+
+
+# process-wide lookup cache, None when disabled
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None and app.config['CACHE_SIZE'] > 0:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LRUCache(app.config['CACHE_SIZE'], app.config['CACHE_TTL'])
+    return _cache
+
+
+# process-wide slow query log, None when disabled
+_slow_log = None
+_slow_log_lock = threading.Lock()
+
+
+def get_slow_log():
+    global _slow_log
+    if _slow_log is None and app.config['SLOW_QUERY_MS'] is not None:
+        with _slow_log_lock:
+            if _slow_log is None:
+                logger = file_logger(app.config['SLOW_QUERY_LOG'],
+                                     max_bytes=app.config['SLOW_QUERY_LOG_BYTES'],
+                                     backups=app.config['SLOW_QUERY_LOG_BACKUPS'])
+                _slow_log = SlowQueryLog(app.config['SLOW_QUERY_MS'], logger)
+    return _slow_log
+
+
+# process-wide album ingest queue and its writer thread, created on first use
+_ingest = None
+_ingest_lock = threading.Lock()
+
+
+def get_ingest_queue():
+    global _ingest
+    if _ingest is None:
+        pool, cache, slow_log = get_pool(), get_cache(), get_slow_log()
+        with _ingest_lock:
+            if _ingest is None:
+                _ingest = IngestQueue(pool, cache, slow_log,
+                                      batch_size=app.config['INGEST_BATCH_SIZE'],
+                                      batch_wait=app.config['INGEST_BATCH_WAIT'],
+                                      max_queued=app.config['INGEST_MAX_QUEUED'])
+    return _ingest
+
+
+# gets a reader connection to the database from the pool, for the rest of the request
 def get_db_conn():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
+        db = g._database = get_pool().acquire()
+
+    return db
+
+
+# gets the single writer connection, for the rest of the request.
+# use this for anything that inserts/updates/drops
+def get_db_writer():
+    db = getattr(g, '_writer', None)
+    if db is None:
+        db = g._writer = get_pool().acquire_writer()
+
+    return db
+
+
+# gets a read only connection for /web/query, for the rest of the request
+def get_sandbox_conn():
+    db = getattr(g, '_sandbox', None)
+    if db is None:
+        db = g._sandbox = get_sandbox_pool().acquire()
 
     return db
 
 
+# query args of the list endpoints (songs/by_album, songs/by_artist, albums/by_artist):
+#   limit=N        at most N items
+#   after=<id>     keyset cursor, only items after this one (see each endpoint for the key)
+#   stream=1       send the list as chunked JSON, serialized straight from the DB cursor
+# returns (after, limit, stream), after and limit are None when not given
+def list_args():
+    after = _int_arg('after')
+    limit = _int_arg('limit')
+    if limit is not None and limit < 1:
+        raise InvalidUsage("limit must be positive")
+    stream = request.args.get('stream', '0').lower() in ('1', 'true', 'yes')
+    return after, limit, stream
+
+
+def _int_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise InvalidUsage("%s must be an integer" % name)
+
+
+# response for a list endpoint from an iterator of (cursor, values) (the DB iter_* methods),
+# values being encoded with template (db.RowTemplate).
+# a full page sets the X-Next-After header to the cursor to pass as after= for the next page;
+# streamed responses have no header since it is only known at the end
+def list_response(items, template, limit, stream):
+    if stream:
+        return hold_connections(Response(stream_with_context(_stream_json_list(items, template)),
+                                         mimetype="application/json"))
+    rows = []
+    last = None
+    for last, values in items:
+        rows.append(values)
+    response = json_response(template.encode_list(rows))
+    if limit is not None and len(rows) == limit:
+        response.headers['X-Next-After'] = str(last)
+    return response
+
+
+def _stream_json_list(items, template):
+    yield "["
+    try:
+        for i, (cursor, values) in enumerate(items):
+            yield ("," if i else "") + template.encode(values)
+    except sqlite3.Error as e:
+        # the status line is already sent, all we can do is cut the list short
+        logging.error(e)
+    yield "]\n"
+
+
+# response for JSON text that is already encoded, the same body jsonify would give
+def json_response(text):
+    return Response(text + "\n", mimetype="application/json")
+
+
 # Error Class for managing Errors
 class InvalidUsage(Exception):
     status_code = 400
@@ -478,12 +1064,49 @@ def handle_invalid_usage(error):
     response.status_code = error.status_code
     return response
 
-# called on close of response; closes db connection
+# request timing for /metrics. The time is until the view returns its response, so for
+# streamed lists (stream=1) it stops before the body is sent
+@app.before_request
+def start_request_timer():
+    if app.config['METRICS_ENABLED']:
+        g._request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop('_request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        metrics.REQUEST_SECONDS.observe((request.method, route, str(response.status_code)),
+                                        time.perf_counter() - started)
+    return response
+
+
+# called on close of response; returns db connections to the pool
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    release_connections(g.pop('_database', None), g.pop('_writer', None), g.pop('_sandbox', None))
+
+
+def release_connections(db, writer, sandbox):
     if db is not None:
-        db.close()
+        get_pool().release(db)
+    if writer is not None:
+        get_pool().release_writer(writer)
+    if sandbox is not None:
+        # a query stopped mid stream leaves its progress handler behind
+        sandbox.set_progress_handler(None, 0)
+        get_sandbox_pool().release(sandbox)
+
+
+# A streamed response reads from its connections after the view has returned, but Flask
+# runs the teardown above as soon as the view returns (and again once the stream ends).
+# The request's connections are handed to the response instead, and go back to the
+# pool when the server closes it, whether the stream ended or the client went away
+def hold_connections(response):
+    held = (g.pop('_database', None), g.pop('_writer', None), g.pop('_sandbox', None))
+    response.call_on_close(lambda: release_connections(*held))
+    return response
 
 
 # ########### post MS1 ############## #
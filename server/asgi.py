@@ -0,0 +1,180 @@
+import asyncio
+import io
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import InternalServerError
+
+from app import app as flask_app
+
+# ASGI entry point for the Flask app in app.py.
+#
+# Every request goes through the Flask app itself (flask_app.wsgi_app): its URL map,
+# view functions, error handlers and request metrics, so both entry points answer
+# every route the same way and a new route needs no second copy here. What this adds
+# is the serving model.
+#
+# The event loop never touches SQLite. Every request runs on a thread of a
+# ThreadPoolExecutor with ASGI_DB_THREADS workers. At most ASGI_MAX_PENDING requests
+# wait for a thread; past that new requests wait to be admitted, so a burst cannot
+# queue unbounded work behind the database. sqlite3 releases the GIL while a statement
+# runs, so the threads overlap on I/O and on the SQLite side.
+#
+# The request body is read in full before the request is dispatched. A response with
+# a Content-Length is built on the thread and sent at once; a streamed one (?stream=1,
+# /web/query) is read from the app a chunk at a time on the executor and sent as it comes.
+#
+# Run it under an ASGI server, from the server directory:
+#   uvicorn asgi:app --port 5001
+#   hypercorn asgi:app --bind 127.0.0.1:5001
+# (bench/asgi_server.py is a bare-bones server for the benchmarks only.)
+
+flask_app.config.setdefault('ASGI_DB_THREADS', flask_app.config['DB_POOL_SIZE'])
+flask_app.config.setdefault('ASGI_MAX_PENDING', 4 * flask_app.config['DB_POOL_SIZE'])
+
+
+# the WSGI environ of an ASGI http request with its whole body
+def wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client")
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "CONTENT_LENGTH": str(len(body)),
+        "REMOTE_ADDR": client[0] if client else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_LENGTH":
+            continue
+        key = name if name == "CONTENT_TYPE" else "HTTP_" + name
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+# Runs a request through the Flask app, in the calling (executor) thread. Returns
+# (status, headers, body, chunks): body is the whole response when it has a
+# Content-Length, otherwise chunks is the app's iterator to read it from.
+# Anything the app raises is answered with a 500
+def run_flask(environ):
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(" ", 1)[0]),
+                      [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]]
+
+    try:
+        chunks = flask_app.wsgi_app(environ, start_response)
+    except Exception:
+        logging.exception("error serving %s %s", environ["REQUEST_METHOD"], environ["PATH_INFO"])
+        chunks = InternalServerError()(environ, start_response)
+    status, headers = started
+    if not any(name == b"content-length" for name, value in headers):
+        return status, headers, None, chunks
+    try:
+        return status, headers, b"".join(chunks), None
+    finally:
+        close_chunks(chunks)
+
+
+# the next chunk of a streamed response, or None once it has ended (or failed; the
+# status is already sent then, so the body is just cut short)
+def next_chunk(chunks):
+    try:
+        return next(chunks)
+    except StopIteration:
+        return None
+    except Exception:
+        logging.exception("error streaming a response")
+        return None
+
+
+# ends a response; for a streamed one this returns its connections to the pool (see
+# hold_connections in app.py)
+def close_chunks(chunks):
+    close = getattr(chunks, "close", None)
+    if close is not None:
+        close()
+
+
+class App:
+    def __init__(self, config):
+        self.config = config
+        self._executor = None
+        self._admission = None
+
+    def _start(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.config['ASGI_DB_THREADS'], thread_name_prefix="db")
+            self._admission = asyncio.Semaphore(self.config['ASGI_DB_THREADS'] + self.config['ASGI_MAX_PENDING'])
+
+    def _stop(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        self._start()
+        environ = wsgi_environ(scope, await read_body(receive))
+        loop = asyncio.get_running_loop()
+        async with self._admission:
+            status, headers, body, chunks = await loop.run_in_executor(self._executor, run_flask, environ)
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            if chunks is None:
+                await send({"type": "http.response.body", "body": body})
+                return
+            it = iter(chunks)
+            try:
+                while True:
+                    chunk = await loop.run_in_executor(self._executor, next_chunk, it)
+                    if chunk is None:
+                        break
+                    if chunk:
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b""})
+            finally:
+                await loop.run_in_executor(self._executor, close_chunks, chunks)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self._stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+app = App(flask_app.config)
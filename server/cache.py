@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+# In-process LRU cache for lookup results, with an optional TTL.
+#
+# Every entry is stored with a set of tags, the ids it was built from, eg
+# {("album", 76), ("song", 115)}. invalidate(tags) drops every entry carrying
+# one of them, which is how DB.add_album keeps cached lookups fresh.
+#
+# The cache is per process: with several server processes a write made by one
+# of them is only seen by the others once their entries expire (set a ttl).
+
+
+class LRUCache:
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (value, expires, tags)
+        self._by_tag = {}  # tag -> set of keys
+        self._generation = 0  # bumped by every invalidate/clear
+        self._lock = threading.Lock()
+
+    # returns the cached value for key, or calls compute() -> (value, tags) and caches that.
+    # tags=None means the value must not be cached. exceptions from compute() are not cached
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                self._remove(key)
+            self.misses += 1
+            generation = self._generation
+        value, tags = compute()
+        with self._lock:
+            # a write that happened while computing may have made value stale already
+            if tags is not None and generation == self._generation:
+                self._put(key, value, tags)
+        return value
+
+    def _put(self, key, value, tags):
+        if key in self._entries:
+            self._remove(key)
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (value, expires, tags)
+        for tag in tags:
+            self._by_tag.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        value, expires, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tag[tag]
+
+    # drops every entry tagged with any of tags
+    def invalidate(self, tags):
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in list(self._by_tag.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._by_tag.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "invalidations": self.invalidations}
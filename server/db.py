@@ -1,6 +1,13 @@
+import collections
+import datetime
+import functools
+import json
 import logging
+import operator
 import sqlite3
+import time
 from flask.cli import with_appcontext
+from queries import QUERIES
 
 # helper function that converts query result to json list, after cursor has executed a query
 # this will not work for all endpoints direct, just the ones where you can translate
@@ -11,6 +18,450 @@ def to_json(cursor):
     return [dict(zip(headers, row)) for row in results]
 
 
+# Precompiled JSON encoding for rows of one query shape, so list endpoints can go from
+# cursor rows to JSON text without the per-row dicts of to_json and the key sort jsonify does.
+# The keys are sorted once here; each row becomes an already ordered dict that the C json
+# encoder writes as-is. The text is byte for byte what flask.jsonify produces for to_dict(row)
+# with compact output only: in debug mode (or with app.json.compact = False) jsonify indents,
+# and these endpoints still send compact JSON.
+class RowTemplate:
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        order = sorted(range(len(self.keys)), key=lambda i: self.keys[i])
+        self._sorted_keys = tuple(self.keys[i] for i in order)
+        self._sorted_values = operator.itemgetter(*order)
+        self._encoder = json.JSONEncoder(separators=(",", ":"))
+
+    def to_dict(self, values):
+        return dict(zip(self.keys, values))
+
+    def encode(self, values):
+        return self._encoder.encode(dict(zip(self._sorted_keys, self._sorted_values(values))))
+
+    # JSON text of a whole list of rows
+    def encode_list(self, rows):
+        keys, sorted_values = self._sorted_keys, self._sorted_values
+        return self._encoder.encode([dict(zip(keys, sorted_values(values))) for values in rows])
+
+
+# key templates of the list endpoints, keys in the order the dicts have always had
+SONG_ROW = RowTemplate(("song_id", "song_name", "length", "artist_ids"))
+ALBUM_ROW = RowTemplate(("album_id", "album_name", "release_year"))
+
+
+# builds the songs for the songs/by_* endpoints from a cursor whose rows are
+# (group, song_id, song_name, length, artist_id), one row per artist of a song and
+# ordered by group then artist_id. Consecutive rows with the same group are one song.
+# Yields (group, song) as soon as each song is complete, reading the cursor lazily;
+# song is a list of values in SONG_ROW order
+def iter_songs_with_artists(cursor):
+    group = song = None
+    for row in cursor:
+        if song is None or row[0] != group:
+            if song is not None:
+                yield group, song
+            group = row[0]
+            song = [row[1], row[2], row[3], []]
+        if row[4] is not None:
+            song[3].append(row[4])
+    if song is not None:
+        yield group, song
+
+
+# keyset pagination over a query registered with QUERIES.register_paged: the name of the
+# statement to run for an `after` cursor, and the LIMIT value (-1 is no limit in SQLite)
+def page_query(name, after, limit):
+    if after is not None:
+        name += "_after"
+    return name, (limit if limit is not None else -1)
+
+
+# tables written by the album ingest path, in insert order, and their statements in queries.py
+ALBUM_INSERTS = {
+    "album": "insert_album",
+    "artist": "insert_artist",
+    "song": "insert_song",
+    "song_artist": "insert_song_artist",
+    "song_album": "insert_song_album",
+    "artist_album": "insert_artist_album",
+}
+
+
+# Album post schema, (key, type) of every field of each kind of object.
+# Types are matched exactly, so eg true or 1.5 is not an id. A song's length and an
+# artist's country may also be null, like their columns
+ALBUM_FIELDS = (("album_id", int), ("album_name", str), ("release_year", int),
+                ("artists", list), ("songs", list))
+SONG_FIELDS = (("song_id", int), ("song_name", str), ("length", int), ("artists", list))
+ARTIST_FIELDS = (("artist_id", int), ("artist_name", str), ("country", str))
+
+TYPE_NAMES = {int: "an integer", str: "a string", list: "a list"}
+
+# SQLite stores 64-bit integers; sqlite3 raises OverflowError for any int outside this range
+INT_MIN, INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+# at most this many problems are reported for one album
+MAX_ERRORS = 50
+
+
+# Precompiled key check for one kind of object of an album post: an itemgetter reading
+# every field in schema order. A dict with as many keys as the schema from which `fields`
+# reads every name has exactly the schema's keys, so a good object costs a len() and one C
+# call, with no set built; a missing key raises KeyError and a non-object TypeError.
+# parse_album checks the types of the values inline as it unpacks them (several times
+# cheaper than a loop over the fields). Only a bad object is looked at key by key, in
+# explain(), to say what is wrong with it. Keys in nullable may also be null
+class ObjectSchema:
+    def __init__(self, fields, nullable=()):
+        self.names = tuple(key for key, value_type in fields)
+        self.types = tuple(value_type for key, value_type in fields)
+        self.nullable = frozenset(nullable)
+        self.size = len(fields)
+        self.fields = operator.itemgetter(*self.names)
+
+    # adds what is wrong with obj, found at path in the album, to errors
+    def explain(self, obj, path, errors):
+        if not isinstance(obj, dict):
+            errors.append("%s is not a JSON object" % path)
+            return
+        missing = [key for key in self.names if key not in obj]
+        if missing:
+            errors.append("%s: missing %s" % (path, ", ".join(missing)))
+        unknown = sorted(str(key) for key in obj if key not in self.names)
+        if unknown:
+            errors.append("%s: unknown %s" % (path, ", ".join(unknown)))
+        for key, value_type in zip(self.names, self.types):
+            if key not in obj or obj[key] is None and key in self.nullable:
+                continue
+            if type(obj[key]) is not value_type:
+                expected = TYPE_NAMES[value_type] + (" or null" if key in self.nullable else "")
+                errors.append("%s.%s: expected %s" % (path, key, expected))
+            elif value_type is int and not INT_MIN <= obj[key] <= INT_MAX:
+                errors.append("%s.%s: out of the 64-bit integer range" % (path, key))
+
+
+ALBUM_SCHEMA = ObjectSchema(ALBUM_FIELDS)
+SONG_SCHEMA = ObjectSchema(SONG_FIELDS, nullable=("length",))
+ARTIST_SCHEMA = ObjectSchema(ARTIST_FIELDS, nullable=("country",))
+
+
+# index of obj in items by identity (list.index would match an earlier equal item)
+def position(items, obj):
+    return next(i for i, item in enumerate(items) if item is obj)
+
+
+# Validates an album post body and collects the rows for every table it touches, keyed like
+# ALBUM_INSERTS, in a single pass over the album. Songs are numbered by their position in
+# the album starting at 1 (order_in_album). Artists credited only on songs are rows too.
+# raise BadRequest() with every problem found (up to MAX_ERRORS) in errors if the album is malformed
+def parse_album(post_body):
+    errors = []
+    try:
+        album_id, album_name, release_year, artists, songs = ALBUM_SCHEMA.fields(post_body)
+        valid = (len(post_body) == ALBUM_SCHEMA.size and type(album_id) is int and INT_MIN <= album_id <= INT_MAX
+                 and type(album_name) is str and type(release_year) is int and INT_MIN <= release_year <= INT_MAX
+                 and type(artists) is list and type(songs) is list)
+    except (KeyError, TypeError):
+        valid = False
+    if not valid:
+        ALBUM_SCHEMA.explain(post_body, "album", errors)
+        if not isinstance(post_body, dict):
+            raise BadRequest(errors[0], errors=errors)
+        # look inside what is there anyway, to report everything at once
+        album_id, album_name, release_year = (post_body.get(key) for key in ALBUM_SCHEMA.names[:3])
+        artists = post_body.get("artists") if type(post_body.get("artists")) is list else []
+        songs = post_body.get("songs") if type(post_body.get("songs")) is list else []
+    song_fields, song_size = SONG_SCHEMA.fields, SONG_SCHEMA.size
+    artist_fields, artist_size = ARTIST_SCHEMA.fields, ARTIST_SCHEMA.size
+    artist_rows = []
+    artist_album = []
+    song_rows = []
+    song_artist = []
+    song_album = []
+    artist_ids = set()
+    for artist in artists:
+        try:
+            row = artist_id, artist_name, country = artist_fields(artist)
+            valid = (len(artist) == artist_size and type(artist_id) is int and INT_MIN <= artist_id <= INT_MAX
+                     and type(artist_name) is str and (country is None or type(country) is str))
+        except (KeyError, TypeError):
+            valid = False
+        if not valid:
+            ARTIST_SCHEMA.explain(artist, "artists[%d]" % position(artists, artist), errors)
+            continue
+        artist_rows.append(row)
+        artist_album.append((artist_id, album_id))
+        artist_ids.add(artist_id)
+    for order_in_album, song in enumerate(songs, 1):
+        try:
+            song_id, song_name, length, song_artists = song_fields(song)
+            valid = (len(song) == song_size and type(song_id) is int and INT_MIN <= song_id <= INT_MAX
+                     and type(song_name) is str
+                     and (length is None or type(length) is int and INT_MIN <= length <= INT_MAX)
+                     and type(song_artists) is list)
+        except (KeyError, TypeError):
+            valid = False
+        if not valid:
+            SONG_SCHEMA.explain(song, "songs[%d]" % (order_in_album - 1), errors)
+            if len(errors) >= MAX_ERRORS:
+                break
+            continue
+        song_rows.append((song_id, song_name, length))
+        song_album.append((song_id, album_id, order_in_album))
+        for artist in song_artists:
+            try:
+                row = artist_id, artist_name, country = artist_fields(artist)
+                valid = (len(artist) == artist_size and type(artist_id) is int and INT_MIN <= artist_id <= INT_MAX
+                         and type(artist_name) is str and (country is None or type(country) is str))
+            except (KeyError, TypeError):
+                valid = False
+            if not valid:
+                path = "songs[%d].artists[%d]" % (order_in_album - 1, position(song_artists, artist))
+                ARTIST_SCHEMA.explain(artist, path, errors)
+                continue
+            song_artist.append((song_id, artist_id))
+            # artists credited only on songs exist too
+            if artist_id not in artist_ids:
+                artist_ids.add(artist_id)
+                artist_rows.append(row)
+    if errors:
+        errors = errors[:MAX_ERRORS]
+        raise BadRequest("; ".join(errors), errors=errors)
+    return {
+        "album": [(album_id, album_name, release_year)],
+        "artist": artist_rows,
+        "song": song_rows,
+        "song_artist": song_artist,
+        "song_album": song_album,
+        "artist_album": artist_album,
+    }
+
+
+# writes the rows from parse_album with one executemany per table, then recomputes the
+# solo flag of the albums they can change unless solo is False. does not commit
+def insert_album_rows(cursor, rows, slow_log=None, solo=True):
+    inserted = {}
+    for table, query in ALBUM_INSERTS.items():
+        if rows[table]:
+            inserted[table] = QUERIES.executemany(cursor, query, rows[table], slow_log).rowcount
+    if not solo:
+        return
+    album_id = rows["album"][0][0]
+    # other albums only change when a song that was already there got a new artist
+    if inserted.get("song_artist", 0) and inserted["song"] < len(rows["song"]):
+        QUERIES.execute(cursor, "update_solo", {"album_id": album_id,
+                                                "song_ids": json.dumps([row[0] for row in rows["song"]])}, slow_log)
+    else:
+        QUERIES.execute(cursor, "update_solo_album", {"album_id": album_id}, slow_log)
+
+
+# the FTS5 query (see queries.py "search") matching names with every word of q, each word
+# also matching as a prefix. Words are quoted, so FTS5 operators and punctuation in them
+# are taken as text. raise BadRequest() if q has no words
+def search_match(q):
+    words = q.split() if isinstance(q, str) else []
+    if not words:
+        raise BadRequest("q must have at least one word")
+    return " ".join('"%s"*' % word.replace('"', '""') for word in words)
+
+
+# A play event, eg {"song_id": 12, "played_at": "2024-05-01T18:04:11Z", "country": "SE",
+# "source": "mobile"}. played_at is ISO 8601, in UTC unless it has an offset
+PLAY_SCHEMA = ObjectSchema((("song_id", int), ("played_at", str), ("country", str), ("source", str)))
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+# the day number (days since 1970-01-01) of a YYYY-MM-DD date.
+# raise BadRequest() if it is not one
+def parse_day(date):
+    try:
+        return datetime.date.fromisoformat(date).toordinal() - EPOCH_ORDINAL
+    except (TypeError, ValueError):
+        raise BadRequest("date must be YYYY-MM-DD")
+
+
+# (played_at as seconds since the epoch, day, song_id, country, source) of a play event.
+# raise BadRequest() with what is wrong with it otherwise
+def parse_play(event):
+    try:
+        song_id, played_at, country, source = PLAY_SCHEMA.fields(event)
+        valid = (len(event) == PLAY_SCHEMA.size and type(song_id) is int and type(played_at) is str
+                 and type(country) is str and type(source) is str and country and source)
+    except (KeyError, TypeError):
+        valid = False
+    if not valid:
+        errors = []
+        PLAY_SCHEMA.explain(event, "play", errors)
+        if not errors:
+            errors.append("play: country and source must not be empty")
+        raise BadRequest("; ".join(errors), errors=errors)
+    try:
+        moment = datetime.datetime.fromisoformat(played_at)
+    except ValueError:
+        raise BadRequest("play.played_at: expected an ISO 8601 date and time")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    seconds = int(moment.timestamp())
+    return seconds, seconds // 86400, song_id, country, source
+
+
+# at most this many failed events are listed in the result of DB.add_plays
+MAX_PLAY_ERRORS = 100
+
+
+# The monthly table holding the raw play events of day, created if needed, and the name
+# of its registered insert statement. Rows are only ever appended, in arrival order, and
+# the table has no index to maintain; a month of history is dropped with its table
+def play_partition(cursor, day):
+    date = datetime.date.fromordinal(day + EPOCH_ORDINAL)
+    table = "play_%04d%02d" % (date.year, date.month)
+    cursor.execute("""CREATE TABLE IF NOT EXISTS %s (
+        played_at INT NOT NULL,
+        song_id INT NOT NULL,
+        country_id INT NOT NULL,
+        source_id INT NOT NULL)""" % table)
+    return QUERIES.ensure("insert_" + table,
+                          "INSERT INTO %s (played_at, song_id, country_id, source_id) VALUES (?, ?, ?, ?)" % table)
+
+
+# ids as ints, for cache tags. None if value is not exactly an integer id
+def int_id(value):
+    try:
+        as_int = int(value)
+    except (TypeError, ValueError):
+        return None
+    return as_int if str(as_int) == str(value) else None
+
+
+# the ids of a batch lookup, eg "1,2,3", as a list of ints in order without duplicates.
+# raise BadRequest() if ids is not such a list or has more than max_ids of them
+def parse_ids(ids, max_ids):
+    try:
+        res = list(dict.fromkeys(int(i) for i in ids.split(",")))
+    except (AttributeError, ValueError):
+        raise BadRequest("ids must be a comma separated list of integers")
+    if len(res) > max_ids:
+        raise BadRequest("at most %d ids per request" % max_ids)
+    return res
+
+
+# the result of a batch lookup: {kind: {id: object}, "missing": [id]}, both in the order
+# of ids. found maps the ids that exist to their objects
+def batch_result(kind, ids, found):
+    return {kind: {str(i): found[i] for i in ids if i in found},
+            "missing": [i for i in ids if i not in found]}
+
+
+# cache tags of everything an album post can change (see cache.py), or None if some id
+# is not an integer and so cannot be matched against the tags of cached lookups
+def album_tags(rows):
+    ids = [("album", r[0]) for r in rows["album"]]
+    ids += [("artist", r[0]) for r in rows["artist"]]
+    ids += [("artist", r[1]) for r in rows["song_artist"]]
+    ids += [("song", r[0]) for r in rows["song"]]
+    tags = {(kind, int_id(i)) for kind, i in ids}
+    if any(i is None for kind, i in tags):
+        return None
+    return tags
+
+
+# decorator for DB lookups taking a single id. Results are cached in self.cache (if any)
+# under (endpoint, id) and tagged with tags(id, result), the ids the result depends on.
+# KeyNotFound and other errors are not cached
+def cached(endpoint, tags):
+    def wrap(method):
+        @functools.wraps(method)
+        def lookup(self, key_id):
+            if self.cache is None:
+                return method(self, key_id)
+            def compute():
+                res = method(self, key_id)
+                return res, tags(key_id, res)
+            return self.cache.get_or_compute((endpoint, str(key_id)), compute)
+        return lookup
+    return wrap
+
+
+# JSON text returned by the *_json lookups. song_ids lists the songs in it, for cache tags
+class JSONText(str):
+    def __new__(cls, text, song_ids=()):
+        self = str.__new__(cls, text)
+        self.song_ids = song_ids
+        return self
+
+
+# tags of a by_album/by_artist result: the album or artist itself and every song listed
+def _songs_tags(kind, key_id, res):
+    key_id = int_id(key_id)
+    if key_id is None:
+        return None
+    if isinstance(res, JSONText):
+        song_ids = res.song_ids
+    else:
+        song_ids = [song["song_id"] for song in res]
+    return {(kind, key_id)} | {("song", song_id) for song_id in song_ids}
+
+
+# tags of a find_album_full result: the album and its songs. Artists are not tagged, an
+# artist's details never change once inserted
+def _album_full_tags(album_id, res):
+    return {("album", res["album_id"])} | {("song", song["song_id"]) for song in res["songs"]}
+
+
+# at most this many failed albums are listed in the result of DB.add_albums
+MAX_ALBUM_ERRORS = 100
+
+
+# Rows of an ad hoc query run by DB.run_sandboxed, read from the cursor as they are
+# iterated (once). Iteration ends early after max_rows rows, setting truncated, or when
+# the query fails or runs out of time, setting error to the message. The progress
+# handler that enforces the time budget is removed when iteration ends, and only then is
+# the query checked against slow_log, timed from started (so the time covers reading
+# the rows, which are streamed to the client as they are read).
+class SandboxedRows:
+    def __init__(self, conn, cursor, max_rows, timeout, slow_log=None, query=None, started=None):
+        self.conn = conn
+        self.columns = [d[0] for d in cursor.description or ()]
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self.slow_log = slow_log
+        self.query = query
+        self.started = started
+        self.truncated = False
+        self.error = None
+        self.count = 0
+        self._cursor = cursor
+
+    def __iter__(self):
+        try:
+            for row in self._cursor:
+                if self.count >= self.max_rows:
+                    self.truncated = True
+                    break
+                self.count += 1
+                yield row
+        except sqlite3.Error as e:
+            self.error = sandbox_error(e, self.timeout)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
+            self.conn.set_progress_handler(None, 0)
+            if self.slow_log is not None:
+                self.slow_log.check(self.conn, None, self.query, (), time.monotonic() - self.started)
+
+
+# message for an error of a sandboxed query; SQLite reports a stopped query as interrupted
+def sandbox_error(e, timeout):
+    if isinstance(e, sqlite3.OperationalError) and str(e) == "interrupted":
+        return "query took longer than %g seconds and was stopped" % timeout
+    return str(e)
+
+
 # Error class for when a key is not found
 class KeyNotFound(Exception):
     def __init__(self, message=None):
@@ -27,18 +478,22 @@ class KeyNotFound(Exception):
 
 
 # Error class for when request data is bad
+# errors optionally lists every problem found, when there is more than one to report
 class BadRequest(Exception):
-    def __init__(self, message=None, error_code=400):
+    def __init__(self, message=None, error_code=400, errors=None):
         Exception.__init__(self)
         if message:
             self.message = message
         else:
             self.message = "Bad Request"
         self.error_code = error_code
+        self.errors = errors
 
     def to_dict(self):
         rv = dict()
         rv['message'] = self.message
+        if self.errors:
+            rv['errors'] = self.errors
         return rv
 
 
@@ -47,28 +502,79 @@ Wraps a single connection to the database with higher-level functionality.
 Holds the DB connection
 """
 class DB:
-    def __init__(self, connection):
+    # cache is an optional cache.LRUCache shared between requests,
+    # slow_log an optional slowlog.SlowQueryLog for statements over its threshold
+    def __init__(self, connection, cache=None, slow_log=None):
         self.conn = connection
+        self.cache = cache
+        self.slow_log = slow_log
+        # album inserts leave album.solo alone when set; load.py sets it and runs
+        # update_solo_all once the albums and the indexes are in
+        self.defer_solo = False
+
+    # runs a registered statement (see queries.py) on cursor and returns the cursor
+    def execute(self, cursor, name, params=()):
+        return QUERIES.execute(cursor, name, params, self.slow_log)
+
+    # runs a registered statement and returns all its rows
+    def fetchall(self, cursor, name, params=()):
+        return QUERIES.fetchall(cursor, name, params, self.slow_log)
+
+    # runs a registered statement once per set of parameters in seq_of_params (a list)
+    def executemany(self, cursor, name, seq_of_params):
+        return QUERIES.executemany(cursor, name, seq_of_params, self.slow_log)
+
+    # drops cached lookups that the given album rows can change
+    def invalidate_album(self, rows):
+        if self.cache is None:
+            return
+        tags = album_tags(rows)
+        if tags is None:
+            self.cache.clear()
+        else:
+            self.cache.invalidate(tags)
+
+    # moves the names queued in name_search_pending by the song, album and artist insert
+    # triggers into the name_search index. run before committing album inserts
+    def flush_names(self, cursor):
+        self.execute(cursor, "flush_names")
+        self.execute(cursor, "clear_pending_names")
 
-    # Simple example of how to execute a query against the DB.
-    # Again NEVER do this, you should only execute parameterized query
-    # See https://docs.python.org/3/library/sqlite3.html#sqlite3.Cursor.execute
-    # This is the qmark style:
-    # cur.execute("insert into people values (?, ?)", (who, age))
-    # And this is the named style:
-    # cur.execute("select * from people where name_last=:who and age=:age", {"who": who, "age": age})
-    def run_query(self, query):
+    # Runs an ad hoc query from /web/query. The connection should be read only (pool.connect
+    # with read_only=True), as nothing here stops the query from writing.
+    # SQLite's progress handler stops the query once it has run for timeout seconds,
+    # and at most max_rows rows are read. Returns SandboxedRows, which reads the rows lazily
+    # so they can be streamed; the time budget covers reading them too.
+    # raise BadRequest() if the query fails or times out before its first row
+    def run_sandboxed(self, query, max_rows=1000, timeout=2.0):
+        started = time.monotonic()
+        deadline = started + timeout
+        # checked every 1000 SQLite VM instructions, a few microseconds apart
+        self.conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
         c = self.conn.cursor()
-        c.execute(query)
-        res = to_json(c)
-        self.conn.commit()
-        return res
+        try:
+            c.execute(query)
+        except (sqlite3.Error, sqlite3.Warning) as e:
+            # off before the slow log reads the plan, which would be interrupted too
+            self.conn.set_progress_handler(None, 0)
+            if self.slow_log is not None:
+                self.slow_log.check(self.conn, None, query, (), time.monotonic() - started)
+            raise BadRequest(sandbox_error(e, timeout))
+        # a query that ran is checked once its rows are read (SandboxedRows.close)
+        return SandboxedRows(self.conn, c, max_rows, timeout, self.slow_log, query, started)
 
     # Run script that drops and creates all tables
     def create_db(self, create_file):
-        print("Running SQL script file %s" % create_file)
+        logging.info("Running SQL script file %s", create_file)
+        # the monthly play tables are not in the script (see play_partition)
+        partitions = self.conn.execute("""SELECT name FROM sqlite_master
+            WHERE type = 'table' AND name GLOB 'play_[0-9][0-9][0-9][0-9][0-9][0-9]'""").fetchall()
+        for (table,) in partitions:
+            self.conn.execute("DROP TABLE %s" % table)
         with open(create_file, "r") as f:
             self.conn.executescript(f.read())
+        if self.cache is not None:
+            self.cache.clear()
         return "{\"message\":\"created\"}"
 
 
@@ -78,256 +584,518 @@ class DB:
     # The album should be associated with the artists.  The order does not matter
     # Songs sould be associated with the album, the order *does* matter and should be retained.
     def add_album(self, post_body):
-        try:
-            album_id = post_body["album_id"]
-            album_name = post_body["album_name"]
-            release_year = post_body["release_year"]
-            # An Artist is a dict of {"artist_id", "artist_name", "country" }
-            # Arists is a list of artist [{"artist_id":12, "artist_name":"AA", "country":"XX"},{"arist_id": ...}]
-            artists = post_body["artists"]
-            # Songs is a list of { "song_id", "song_name", "length", "artists" }
-            # Song Id an length are numbers, song_name is a string, artist is a list of artists (above)
-            songs = post_body["songs"]
-        except KeyError as e:
-            raise BadRequest(message="Required attribute is missing")
-        if isinstance(songs, list) is False or isinstance(artists, list) is False:
-            logging.error("song_ids or artist_ids are not lists")
-            raise BadRequest("song_ids or artist_ids are not lists")
-        song_key_list = {"song_id", "song_name", "length", "artists"}
-        artist_key_list = {"artist_id", "artist_name", "country" }
-        if not all(set(song.keys()) == song_key_list for song in songs): 
-            raise BadRequest("bad song")
-        if not all(set(artist.keys()) == artist_key_list for artist in artists):
-            raise BadRequest("bad song")
+        rows = parse_album(post_body)
         c = self.conn.cursor()
-        album_query = "INSERT OR IGNORE INTO album (album_id, album_name, release_year) VALUES (:album_id, :album_name, :release_year)"
-        album_args = {"album_id": album_id, "album_name": album_name, "release_year":release_year}
-        c.execute(album_query, album_args)
-        if artists: 
-            for artist in artists:
-                self.insert_artist_from_album({'artist_id': artist['artist_id'],'artist_name': artist['artist_name'], 'country':artist['country'], 'album_id': album_id})
-        if songs:
-            i = 1
-            for song in songs:
-                post = {"song_id": song['song_id'], "song_name":song['song_name'], "length":song['length'], "artists": song['artists'], "album": {"album_id": album_id, "order_in_album": i}}
-                self.insert_song_from_album(post)
-                i+=1 
+        try:
+            insert_album_rows(c, rows, self.slow_log, not self.defer_solo)
+            self.flush_names(c)
+        except sqlite3.Error:
+            # nothing from a failed album should be left behind
+            self.conn.rollback()
+            raise
+        except OverflowError as e:
+            # parse_album range-checks every integer, this is only a safety net
+            self.conn.rollback()
+            raise BadRequest(str(e))
+        # one commit (and so one fsync) per album
         self.conn.commit()
+        self.invalidate_album(rows)
         return "{\"message\":\"album inserted\"}"
 
-    def insert_song_from_album(self, post_body):
-        # post_body = {song_id : .. , song_name: .. , length: .. , artists: [{artist_id: , artist_name:, country:}], album: {album_id, order_in_album} }
-        song_id = post_body["song_id"]
-        song_name = post_body["song_name"]
-        length = post_body["length"]
-        artists = post_body["artists"]
-        album = post_body["album"]
-        print(artists)
-        c = self.conn.cursor()
-        # insert into songs
-        song_query = "INSERT OR IGNORE INTO song (song_id, song_name, length) VALUES (:song_id, :song_name, :length)"
-        songs = {"song_id": song_id, "song_name":song_name, "length":length }
-        c.execute(song_query, songs)
-        #insert into song_artist
-        song_artist_query = "INSERT OR IGNORE INTO song_artist (song_id, artist_id) VALUES (:song_id, :artist_id)"
-        for artist in artists:
-            song_artist = {"song_id": song_id, "artist_id": artist["artist_id"]} 
-            c.execute(song_artist_query, song_artist)
-        #insert into song_albums 
-        song_album_query = "INSERT OR IGNORE INTO song_album (song_id, album_id, order_in_album) VALUES (:song_id, :album_id, :order_in_album)"
-        song_album = {"song_id": song_id, "album_id":album["album_id"], "order_in_album":album["order_in_album"] }
-        c.execute(song_album_query, song_album)
-        self.conn.commit()
-        return "{\"message\":\"song inserted\"}"
-
-    def insert_artist_from_album(self, post_body):
-        # post_body = artist_id, artist_name, country, album_id
-        artist_id = post_body["artist_id"]
-        artist_name = post_body["artist_name"]
-        country = post_body["country"]
-        album_id = post_body['album_id']
+    # Add many albums, committing once every chunk_size albums instead of once per album.
+    # albums is any iterable of album post bodies (it can be a generator reading a request body).
+    # A bad album does not stop the load: it is rolled back to its savepoint and counted as failed.
+    # If the iterable itself raises BadRequest (malformed JSON) the load stops there, and the
+    # albums already read are still committed.
+    # With parsed set, albums are the rows parse_album already returned for them (the ingest
+    # queue validates albums when they are posted) and are not checked again.
+    # Returns {"inserted": n, "failed": m, "errors": [{"index", "album_id", "message"}]},
+    # listing the first max_errors failures; an invalid album's entry also lists everything
+    # wrong with it in "errors"
+    def add_albums(self, albums, chunk_size=500, max_errors=MAX_ALBUM_ERRORS, parsed=False):
+        res = {"inserted": 0, "failed": 0, "errors": []}
         c = self.conn.cursor()
-        # insert into artist
-        artist_query = "INSERT OR IGNORE INTO artist (artist_id, artist_name, country) VALUES (:artist_id, :artist_name, :country)"
-        artist= { "artist_id": artist_id, 'artist_name': artist_name, "country": country} 
-        c.execute (artist_query,artist) 
-        # insert into artist album 
-        artist_album_query = "INSERT OR IGNORE INTO artist_album (artist_id, album_id) VALUES (:artist_id, :album_id)"
-        artist_album = {'artist_id': artist_id, 'album_id': album_id} 
-        c.execute(artist_album_query, artist_album)
-        # inserted into song artists in insert_song_from_album() so we're good 
+        in_chunk = 0
+        inserted_rows = []
+        index = 0
+        it = iter(albums)
+        while True:
+            try:
+                post_body = next(it)
+            except StopIteration:
+                break
+            except BadRequest as e:
+                self._album_failed(res, max_errors, {"index": index, "album_id": None, "message": e.message})
+                break
+            if not self.conn.in_transaction:
+                c.execute("BEGIN")
+            if parsed:
+                album_id = post_body["album"][0][0]
+            else:
+                album_id = post_body.get("album_id") if isinstance(post_body, dict) else None
+            try:
+                rows = post_body if parsed else parse_album(post_body)
+                c.execute("SAVEPOINT album")
+                try:
+                    insert_album_rows(c, rows, self.slow_log, not self.defer_solo)
+                except (sqlite3.Error, OverflowError):
+                    c.execute("ROLLBACK TO album")
+                    raise
+                finally:
+                    c.execute("RELEASE album")
+                inserted_rows.append(rows)
+                res["inserted"] += 1
+            except BadRequest as e:
+                self._album_failed(res, max_errors, dict(e.to_dict(), index=index, album_id=album_id))
+            except (sqlite3.Error, OverflowError) as e:
+                logging.error(e)
+                self._album_failed(res, max_errors, {"index": index, "album_id": album_id, "message": str(e)})
+            index += 1
+            in_chunk += 1
+            if in_chunk >= chunk_size:
+                self._commit_albums(inserted_rows)
+                in_chunk = 0
+        self._commit_albums(inserted_rows)
+        return res
+
+    def _album_failed(self, res, max_errors, error):
+        res["failed"] += 1
+        if len(res["errors"]) < max_errors:
+            res["errors"].append(error)
+
+    def _commit_albums(self, inserted_rows):
+        if self.conn.in_transaction:
+            try:
+                self.flush_names(self.conn.cursor())
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
         self.conn.commit()
-        return "{\"message\":\"artist inserted\"}"
+        for rows in inserted_rows:
+            self.invalidate_album(rows)
+        del inserted_rows[:]
 
     """
     Returns a song's info
     raise KeyNotFound() if song_id is not found
     """
+    @cached("songs", lambda song_id, res: {("song", res[0]["song_id"])})
     def find_song(self, song_id):
         c = self.conn.cursor()
-        song_query = "SELECT song_id, song_name, length FROM song WHERE song_id =:song_id"
-        c.execute(song_query, {'song_id':song_id})
-        res = to_json(c)
+        res = to_json(self.execute(c, "song_by_id", {'song_id': song_id}))
         length = len(list(res))
         if length==0:
             raise KeyNotFound()
-        song_artist_query = "SELECT artist_id FROM song_artist WHERE song_id = :id ORDER BY artist_id"
-        song_artist_val = {"id": res[0]["song_id"]}
-        c.execute(song_artist_query,song_artist_val)
-        artist_ids = [x[0] for x in c.fetchall()]
+        song_val = {"song_id": res[0]["song_id"]}
+        artist_ids = [x[0] for x in self.fetchall(c, "song_artist_ids", song_val)]
         res[0]["artist_ids"] = artist_ids
-        song_album_query = "SELECT album_id FROM song_album WHERE song_id = :id ORDER BY album_id"
-        song_album_val = {"id": res[0]["song_id"]}
-        c.execute(song_album_query, song_album_val)
-        album_ids = [x[0] for x in c.fetchall()] 
+        album_ids = [x[0] for x in self.fetchall(c, "song_album_ids", song_val)]
         res[0]["album_ids"] = album_ids
         self.conn.commit()
         return res
 
+    """
+    Returns the songs of song_ids (a list of ints, see parse_ids), each as find_song has it,
+    as {"songs": {song_id: song}, "missing": [song_id]} (see batch_result).
+    Three queries whatever the number of ids
+    """
+    def find_songs(self, song_ids):
+        c = self.conn.cursor()
+        ids = {'ids': json.dumps(song_ids)}
+        songs = {}
+        for song_id, song_name, length in self.fetchall(c, "songs_by_ids", ids):
+            songs[song_id] = {"song_id": song_id, "song_name": song_name, "length": length,
+                              "artist_ids": [], "album_ids": []}
+        for song_id, artist_id in self.fetchall(c, "songs_artist_ids", ids):
+            if song_id in songs:
+                songs[song_id]["artist_ids"].append(artist_id)
+        for song_id, album_id in self.fetchall(c, "songs_album_ids", ids):
+            if song_id in songs:
+                songs[song_id]["album_ids"].append(album_id)
+        self.conn.commit()
+        return batch_result("songs", song_ids, songs)
+
     """
     Returns all an album's songs
     raise KeyNotFound() if album_id not found
     """
+    @cached("songs/by_album", functools.partial(_songs_tags, "album"))
     def find_songs_by_album(self, album_id):
-        c = self.conn.cursor()
-        album_query = "SELECT * from album WHERE album_id = :id"
-        album_vals = {'id':album_id}
-        c.execute(album_query, album_vals)
-        if not c.fetchall():
-            raise KeyNotFound()
-        song_album_query = """SELECT song_id, song_name, length FROM song 
-        NATURAL JOIN song_album NATURAL JOIN album 
-        WHERE album_id =:id ORDER BY order_in_album;"""
-        c.execute(song_album_query, album_vals)
-        res = to_json(c)
-        length = len(list(res))
-        if length == 0:
+        res = [SONG_ROW.to_dict(song) for order, song in self.iter_songs_by_album(album_id)]
+        if len(res) == 0:
             raise KeyNotFound()
-        song_artist_query = "SELECT artist_id FROM song_artist WHERE song_id = :song_id ORDER BY artist_id"
-        for song in res:
-            c.execute(song_artist_query, {'song_id': song['song_id']})
-            song['artist_ids'] =[x[0] for x in c.fetchall()]
         self.conn.commit()
         return res
 
+    """
+    find_songs_by_album as JSON text, encoded straight from the rows
+    raise KeyNotFound() if album_id not found
+    """
+    @cached("songs/by_album.json", functools.partial(_songs_tags, "album"))
+    def find_songs_by_album_json(self, album_id):
+        songs = [song for order, song in self.iter_songs_by_album(album_id)]
+        if len(songs) == 0:
+            raise KeyNotFound()
+        self.conn.commit()
+        return JSONText(SONG_ROW.encode_list(songs), [song[0] for song in songs])
+
+    """
+    Yields (order_in_album, song) for an album's songs in album order, starting after
+    order_in_album `after` and stopping after `limit` songs (both optional).
+    song is a list of values in SONG_ROW order
+    raise KeyNotFound() if album_id not found
+    """
+    def iter_songs_by_album(self, album_id, after=None, limit=None):
+        c = self.conn.cursor()
+        album_vals = {'album_id': album_id}
+        if not self.fetchall(c, "album_exists", album_vals):
+            raise KeyNotFound()
+        query, album_vals['limit'] = page_query("songs_by_album", after, limit)
+        album_vals['after'] = after
+        return iter_songs_with_artists(self.execute(c, query, album_vals))
+
     
     """
     Returns all an artists' songs
     raise KeyNotFound() if artist_id is not found
     """
+    @cached("songs/by_artist", functools.partial(_songs_tags, "artist"))
     def find_songs_by_artist(self, artist_id):
-        c = self.conn.cursor()
-        # checking if artist exists
-        artist_query = "SELECT * from artist WHERE artist_id = :artist_id;"
-        artist_val = {'artist_id':artist_id}
-        c.execute(artist_query,artist_val)
-        fetch = c.fetchall()
-        if not fetch:
-            raise KeyNotFound()
-        # fetching songs for artist
-        song_query = """SELECT song_id, song_name, length  
-            FROM song NATURAL JOIN song_artist NATURAL JOIN artist 
-            WHERE artist_id =:artist_id ORDER BY song_id;"""
-        c.execute(song_query, artist_val)
-        res = to_json(c)
+        res = [SONG_ROW.to_dict(song) for song_id, song in self.iter_songs_by_artist(artist_id)]
         # no songs for artist
-        if len(list(res)) ==0:
+        if len(res) == 0:
             raise KeyNotFound()
-        # adding artist ids
-        for song in res:
-            song_artist_query = "SELECT artist_id FROM song_artist WHERE song_id = :song_id ORDER BY artist_id"
-            song_artist_val = {"song_id": song["song_id"]}
-            c.execute(song_artist_query,song_artist_val )
-            song["artist_ids"] = [x[0] for x in c.fetchall()]
         self.conn.commit()
         return res
+
+    """
+    find_songs_by_artist as JSON text, encoded straight from the rows
+    raise KeyNotFound() if artist_id is not found
+    """
+    @cached("songs/by_artist.json", functools.partial(_songs_tags, "artist"))
+    def find_songs_by_artist_json(self, artist_id):
+        songs = [song for song_id, song in self.iter_songs_by_artist(artist_id)]
+        # no songs for artist
+        if len(songs) == 0:
+            raise KeyNotFound()
+        self.conn.commit()
+        return JSONText(SONG_ROW.encode_list(songs), [song[0] for song in songs])
+
+    """
+    Yields (song_id, song) for an artist's songs ordered by song_id, starting after
+    song_id `after` and stopping after `limit` songs (both optional).
+    song is a list of values in SONG_ROW order
+    raise KeyNotFound() if artist_id is not found
+    """
+    def iter_songs_by_artist(self, artist_id, after=None, limit=None):
+        c = self.conn.cursor()
+        # checking if artist exists
+        artist_val = {'artist_id': artist_id}
+        if not self.fetchall(c, "artist_exists", artist_val):
+            raise KeyNotFound()
+        query, artist_val['limit'] = page_query("songs_by_artist", after, limit)
+        artist_val['after'] = after
+        # fetching songs for artist, one row per (song, artist of that song)
+        return iter_songs_with_artists(self.execute(c, query, artist_val))
    
     """
     Returns a album's info
     raise KeyNotFound() if album_id is not found
     """
+    @cached("albums", lambda album_id, res: {("album", res[0]["album_id"])})
     def find_album(self, album_id):
         c = self.conn.cursor()
-        # check if album exists
-        album_id_query = "SELECT * from album WHERE album_id = :album_id;"
-        album_id_val = {'album_id': album_id}
-        c.execute(album_id_query,album_id_val)
-        exists = c.fetchall()
-        if not exists:
+        # retrieve album, which also checks it exists
+        res = to_json(self.execute(c, "album_by_id", {'album_id': album_id}))
+        if not res:
             raise KeyNotFound()
-        # retrieve album 
-        album_query = "SELECT album_id, album_name, release_year FROM album WHERE album_id = :album_id;"
-        c.execute(album_query, album_id_val)
-        res = to_json(c)
         # get artist id 
-        artist_id_query = "SELECT artist_id FROM artist_album WHERE album_id = :album_id ORDER BY artist_id"
-        album_id_val2 = {"album_id": res[0]["album_id"]}
-        c.execute(artist_id_query,album_id_val2)
-        res[0]["artist_ids"] = [x[0] for x in c.fetchall()] 
+        album_id_val = {"album_id": res[0]["album_id"]}
+        res[0]["artist_ids"] = [x[0] for x in self.fetchall(c, "album_artist_ids", album_id_val)]
         # get song id 
-        song_id_query = "SELECT song_id FROM song_album WHERE album_id = :album_id ORDER BY order_in_album"
-        c.execute(song_id_query, album_id_val2)
-        res[0]["song_ids"] = [x[0] for x in c.fetchall()] 
+        res[0]["song_ids"] = [x[0] for x in self.fetchall(c, "album_song_ids", album_id_val)]
 
         self.conn.commit()
         return res
 
     """
-    # not me 
-    Returns a album's info
+    Returns an album with its songs in album order, each with its artist_ids, and the
+    details of every artist of the album or of its songs, keyed by artist_id.
+    Four queries whatever the size of the album, cached as one entry
+    raise KeyNotFound() if album_id is not found
+    """
+    @cached("albums/full", _album_full_tags)
+    def find_album_full(self, album_id):
+        c = self.conn.cursor()
+        res = to_json(self.execute(c, "album_by_id", {'album_id': album_id}))
+        if not res:
+            raise KeyNotFound()
+        album = res[0]
+        album_vals = {'album_id': album["album_id"], 'after': None, 'limit': -1}
+        album["artist_ids"] = [x[0] for x in self.fetchall(c, "album_artist_ids", album_vals)]
+        album["songs"] = [SONG_ROW.to_dict(song) for order, song
+                          in iter_songs_with_artists(self.execute(c, "songs_by_album", album_vals))]
+        album["artists"] = {str(artist["artist_id"]): artist
+                            for artist in to_json(self.execute(c, "album_all_artists", album_vals))}
+        self.conn.commit()
+        return album
+
+    """
+    Returns the albums of album_ids (a list of ints, see parse_ids), each as find_album has it,
+    as {"albums": {album_id: album}, "missing": [album_id]} (see batch_result).
+    Three queries whatever the number of ids
+    """
+    def find_albums(self, album_ids):
+        c = self.conn.cursor()
+        ids = {'ids': json.dumps(album_ids)}
+        albums = {}
+        for album_id, album_name, release_year in self.fetchall(c, "albums_by_ids", ids):
+            albums[album_id] = {"album_id": album_id, "album_name": album_name, "release_year": release_year,
+                                "artist_ids": [], "song_ids": []}
+        for album_id, artist_id in self.fetchall(c, "albums_artist_ids", ids):
+            if album_id in albums:
+                albums[album_id]["artist_ids"].append(artist_id)
+        for album_id, song_id in self.fetchall(c, "albums_song_ids", ids):
+            if album_id in albums:
+                albums[album_id]["song_ids"].append(song_id)
+        self.conn.commit()
+        return batch_result("albums", album_ids, albums)
+
+    """
+    Returns the albums of an artist (album_id, album_name, release_year) ordered by album_id
     raise KeyNotFound() if artist_id is not found 
     if artist exist, but there are no albums then return an empty result (from to_json)
     """
+    @cached("albums/by_artist", lambda artist_id, res: _songs_tags("artist", artist_id, []))
     def find_album_by_artist(self, artist_id):
-        c = self.conn.cursor()
-        # TODO milestone splat
-        res = to_json(c)
+        res = [ALBUM_ROW.to_dict(album) for album_id, album in self.iter_albums_by_artist(artist_id)]
         self.conn.commit()
         return res
 
+    """
+    find_album_by_artist as JSON text, encoded straight from the rows
+    raise KeyNotFound() if artist_id is not found
+    """
+    @cached("albums/by_artist.json", lambda artist_id, res: _songs_tags("artist", artist_id, []))
+    def find_album_by_artist_json(self, artist_id):
+        text = ALBUM_ROW.encode_list(album for album_id, album in self.iter_albums_by_artist(artist_id))
+        self.conn.commit()
+        return JSONText(text)
+
+    """
+    Yields (album_id, album) for an artist's albums ordered by album_id, starting after
+    album_id `after` and stopping after `limit` albums (both optional).
+    album is a row of values in ALBUM_ROW order
+    raise KeyNotFound() if artist_id is not found
+    """
+    def iter_albums_by_artist(self, artist_id, after=None, limit=None):
+        c = self.conn.cursor()
+        if not self.fetchall(c, "artist_exists", {'artist_id': artist_id}):
+            raise KeyNotFound()
+        query, limit = page_query("albums_by_artist", after, limit)
+        self.execute(c, query, {'artist_id': artist_id, 'after': after, 'limit': limit})
+        return ((row[0], row) for row in c)
+
     """
     Returns a artist's info
     raise KeyNotFound() if artist_id is not found 
     """
     # not me 
+    @cached("artists", lambda artist_id, res: {("artist", res[0]["artist_id"])})
     def find_artist(self, artist_id):
         c = self.conn.cursor()
-        c.execute("""SELECT artist_id, artist_name, country FROM artist WHERE artist_id = ?;""", (artist_id,))
-        res = to_json(c)
+        res = to_json(self.execute(c, "artist_by_id", {'artist_id': artist_id}))
         if not len(list(res)):
             raise KeyNotFound()
         self.conn.commit()
         return res
 
+    """
+    Returns the artists of artist_ids (a list of ints, see parse_ids), each as find_artist
+    has it, as {"artists": {artist_id: artist}, "missing": [artist_id]} (see batch_result)
+    """
+    def find_artists(self, artist_ids):
+        c = self.conn.cursor()
+        artists = {row["artist_id"]: row
+                   for row in to_json(self.execute(c, "artists_by_ids", {'ids': json.dumps(artist_ids)}))}
+        self.conn.commit()
+        return batch_result("artists", artist_ids, artists)
+
     """
     Returns the average length of an artist's songs (artist_id, avg_length)
     raise KeyNotFound() if artist_id is not found 
     """
     def avg_song_length(self, artist_id):
         c = self.conn.cursor()
-        #check if artist exsits
-        artist_id_query = "SELECT * from artist WHERE artist_id = :artist_id;"
-        artist_id_val = {'artist_id': artist_id}
-        c.execute(artist_id_query, artist_id_val)
-        exists = c.fetchall()
-        if not exists:
+        # point lookup in the running totals (artist_stats), see queries.py
+        res = to_json(self.execute(c, "avg_song_length", {'artist_id': artist_id}))
+        if not res:
             raise KeyNotFound()
-        length_query ="""SELECT artist_id, ROUND(avg(length),1) AS avg_length
-            FROM song NATURAL JOIN artist NATURAL JOIN song_artist 
-            WHERE artist_id = :artist_id;"""
-        c.execute(length_query, artist_id_val)
-        res = to_json(c)
         self.conn.commit()
         return res
 
 
-#not me 
     """
     Returns top (n=num_artists) artists based on total length of songs
+    raise BadRequest() if num_artists is not a non-negative integer
     """
     def top_length(self, num_artists):
+        try:
+            num_artists = int(num_artists)
+        except ValueError:
+            raise BadRequest("number of artists must be an integer")
+        if num_artists < 0:
+            raise BadRequest("number of artists must not be negative")
+        c = self.conn.cursor()
+        res = to_json(self.execute(c, "top_length", {'n': num_artists}))
+        self.conn.commit()
+        return res
+
+
+    """
+    Returns the solo albums (album_id, album_name, release_year) ordered by album_id:
+    albums with a single artist whose songs are all credited to that artist alone
+    """
+    def solo_albums(self):
         c = self.conn.cursor()
-        # TODO milestone splat
-        res = to_json(c)
+        res = to_json(self.execute(c, "solo_albums"))
+        self.conn.commit()
+        return res
+
+
+    """
+    Returns the songs, albums and artists whose name has every word of q, as a word or
+    the start of one, best match first, (limit) of them (kind, id, name)
+    raise BadRequest() if q has no words
+    """
+    def search(self, q, limit=20):
+        c = self.conn.cursor()
+        res = to_json(self.execute(c, "search", {'match': search_match(q), 'n': limit}))
+        self.conn.commit()
+        return res
+
+
+    # Add play events, committing once every chunk_size events. plays is any iterable of
+    # events (it can be a generator reading a request body). A bad event, or one for a song
+    # that does not exist, is counted as failed and skipped. If the iterable itself raises
+    # BadRequest (malformed JSON) the load stops there, and the events already read are
+    # still written.
+    # Returns {"inserted": n, "failed": m, "errors": [{"index", "message"}]}, listing the
+    # first MAX_PLAY_ERRORS failures
+    def add_plays(self, plays, chunk_size=5000):
+        res = {"inserted": 0, "failed": 0, "errors": []}
+        chunk = []
+        index = 0
+        it = iter(plays)
+        while True:
+            try:
+                event = next(it)
+            except StopIteration:
+                break
+            except BadRequest as e:
+                self._play_failed(res, index, e.message)
+                break
+            try:
+                chunk.append((index,) + parse_play(event))
+            except BadRequest as e:
+                self._play_failed(res, index, e.message)
+            index += 1
+            if len(chunk) >= chunk_size:
+                self._write_plays(chunk, res)
+                chunk = []
+        if chunk:
+            self._write_plays(chunk, res)
+        # unknown songs are only found when their chunk is written
+        res["errors"].sort(key=lambda error: error["index"])
+        return res
+
+    def _play_failed(self, res, index, message):
+        res["failed"] += 1
+        if len(res["errors"]) < MAX_PLAY_ERRORS:
+            res["errors"].append({"index": index, "message": message})
+
+    # Writes one chunk of parsed plays, (index, played_at, day, song_id, country, source),
+    # in one transaction: the raw events to their monthly tables, and their counts, summed
+    # here first, to the daily rollups
+    def _write_plays(self, chunk, res):
+        c = self.conn.cursor()
+        try:
+            if not self.conn.in_transaction:
+                c.execute("BEGIN")
+            song_ids = {play[3] for play in chunk}
+            known = {row[0] for row in self.fetchall(c, "songs_existing", {"ids": json.dumps(sorted(song_ids))})}
+            if len(known) < len(song_ids):
+                for play in chunk:
+                    if play[3] not in known:
+                        self._play_failed(res, play[0], "play.song_id: no song %d" % play[3])
+                chunk = [play for play in chunk if play[3] in known]
+            country_ids = self._play_ids(c, "play_country", {play[4] for play in chunk})
+            source_ids = self._play_ids(c, "play_source", {play[5] for play in chunk})
+
+            partitions = {}
+            songs = collections.Counter()
+            countries = collections.Counter()
+            sources = collections.Counter()
+            for index, played_at, day, song_id, country, source in chunk:
+                country_id = country_ids[country]
+                source_id = source_ids[source]
+                partitions.setdefault(day, []).append((played_at, song_id, country_id, source_id))
+                songs[day, song_id] += 1
+                countries[day, country_id] += 1
+                sources[day, song_id, source_id] += 1
+            months = {}
+            for day, rows in partitions.items():
+                months.setdefault(play_partition(c, day), []).extend(rows)
+            for insert, rows in months.items():
+                self.executemany(c, insert, rows)
+            self.executemany(c, "add_play_song_daily", [key + (n,) for key, n in songs.items()])
+            self.executemany(c, "add_play_country_daily", [key + (n,) for key, n in countries.items()])
+            self.executemany(c, "add_play_source_daily", [key + (n,) for key, n in sources.items()])
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        res["inserted"] += len(chunk)
+
+    # {name: id} for the country or source names (table play_country or play_source),
+    # adding the names not seen before
+    def _play_ids(self, c, table, names):
+        names = sorted(names)
+        self.executemany(c, "insert_" + table, [(name,) for name in names])
+        return dict(self.fetchall(c, table + "_ids", {"names": json.dumps(names)}))
+
+    """
+    Returns the (limit) songs played the most on date (YYYY-MM-DD), most played first
+    (song_id, song_name, play_count)
+    raise BadRequest() if date is not a date
+    """
+    def top_song(self, date, limit=10):
+        c = self.conn.cursor()
+        res = to_json(self.execute(c, "top_song", {'day': parse_day(date), 'n': limit}))
+        self.conn.commit()
+        return res
+
+    """
+    Returns the (limit) countries with the most plays on date (YYYY-MM-DD), most first
+    (country, play_count)
+    raise BadRequest() if date is not a date
+    """
+    def top_country(self, date, limit=10):
+        c = self.conn.cursor()
+        res = to_json(self.execute(c, "top_country", {'day': parse_day(date), 'n': limit}))
+        self.conn.commit()
+        return res
+
+    """
+    Returns the plays of a song on date (YYYY-MM-DD) by source, most first (source, play_count)
+    raise KeyNotFound() if song_id is not found
+    raise BadRequest() if date is not a date
+    """
+    def top_source(self, song_id, date):
+        day = parse_day(date)
+        c = self.conn.cursor()
+        if not self.fetchall(c, "song_by_id", {'song_id': song_id}):
+            raise KeyNotFound()
+        res = to_json(self.execute(c, "top_source", {'day': day, 'song_id': song_id}))
         self.conn.commit()
         return res
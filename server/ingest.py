@@ -0,0 +1,135 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from db import DB
+
+# Asynchronous album ingest through a single writer thread.
+#
+# POST /album (with INGEST_QUEUE on) validates the album, puts the rows parse_album made
+# of it on this queue (so it is not parsed again) and answers 202 with a job id right
+# away. The writer thread takes albums off the queue in batches of up to batch_size,
+# waiting at most batch_wait seconds for a batch to fill, and writes each batch in one
+# transaction through DB.add_albums (one savepoint per album, one commit per batch). Requests never wait on the SQLite write lock,
+# and a burst of posts becomes a few short write transactions that WAL readers do not
+# wait on.
+#
+# A job is "queued" until its batch is committed, then "done" or "failed" (with the
+# reason). Jobs live in memory only: queued albums are lost if the process exits, and
+# only the last `history` finished jobs can be looked up.
+
+
+class QueueFull(Exception):
+    pass
+
+
+class IngestQueue:
+    def __init__(self, pool, cache=None, slow_log=None, batch_size=100, batch_wait=0.005,
+                 max_queued=10000, history=100000):
+        self.pool = pool
+        self.cache = cache
+        self.slow_log = slow_log
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.history = history
+        self.batches = 0
+        self.albums = 0
+        self._queue = queue.Queue(max_queued)
+        self._jobs = OrderedDict()  # job id -> status dict, oldest first
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+        self._thread.start()
+
+    # queues the rows of an album (from db.parse_album) and returns its job id.
+    # raise QueueFull if max_queued albums are already waiting
+    def submit(self, rows):
+        job_id = uuid.uuid4().hex
+        job = {"job_id": job_id, "status": "queued", "album_id": rows["album"][0][0]}
+        with self._lock:
+            self._jobs[job_id] = job
+        try:
+            self._queue.put_nowait((job, rows))
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job_id]
+            raise QueueFull()
+        return job_id
+
+    # the status of a job, or None if the id is unknown (or too old)
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def stats(self):
+        return {"queued": self._queue.qsize(), "batches": self.batches, "albums": self.albums}
+
+    # waits until every album queued so far is written (for tests and benchmarks)
+    def join(self):
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                logging.exception("ingest batch failed")
+                self._finish(batch, {i: str(e) for i in range(len(batch))})
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        conn = self._acquire_writer()
+        try:
+            db = DB(conn, self.cache, self.slow_log)
+            try:
+                # every failure is needed to tell its job why
+                res = db.add_albums([rows for job, rows in batch], chunk_size=len(batch),
+                                    max_errors=len(batch), parsed=True)
+            except sqlite3.Error as e:
+                # the commit itself failed, nothing of the batch was written
+                logging.error(e)
+                self._finish(batch, {i: str(e) for i in range(len(batch))})
+                return
+        finally:
+            self.pool.release_writer(conn)
+        self.batches += 1
+        self.albums += res["inserted"]
+        self._finish(batch, {error["index"]: error["message"] for error in res["errors"]})
+
+    # the writer connection is shared with /create and /albums/bulk; keep trying until they let go
+    def _acquire_writer(self):
+        while True:
+            try:
+                return self.pool.acquire_writer()
+            except sqlite3.OperationalError as e:
+                logging.error("ingest waiting for the writer: %s", e)
+
+    # marks the jobs of batch done, or failed when their index is in failed (index -> message)
+    def _finish(self, batch, failed):
+        with self._lock:
+            for i, (job, rows) in enumerate(batch):
+                if i in failed:
+                    job["status"] = "failed"
+                    job["message"] = failed[i]
+                else:
+                    job["status"] = "done"
+                # finished jobs move to the end, the oldest finished ones are dropped first
+                self._jobs.move_to_end(job["job_id"])
+            while len(self._jobs) > self.history:
+                oldest = next(iter(self._jobs))
+                if self._jobs[oldest]["status"] == "queued":
+                    break
+                del self._jobs[oldest]
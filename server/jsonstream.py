@@ -0,0 +1,165 @@
+import codecs
+import json
+from db import BadRequest
+
+# Incremental reader for request bodies / files holding many JSON documents.
+# Accepts either a single JSON array ([{...}, {...}]) or newline delimited JSON
+# ({...}\n{...}\n), and yields one document at a time without holding the whole
+# body in memory.
+
+READ_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\r\n"
+# a value cut short by the end of the buffer fails at most this many chars before it
+# (a partial -Infinity or \uXXXX escape), or as a string running to the end
+_CUT_SHORT = 12
+
+
+class _Buffer:
+    def __init__(self, stream, read_size):
+        self.stream = stream
+        self.read_size = read_size
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+
+    # drops what has been consumed and appends the next read. returns False at end of stream
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.read_size)
+        self.eof = not chunk
+        self.text = self.text[self.pos:] + self.utf8.decode(chunk or b"", final=self.eof)
+        self.pos = 0
+        return True
+
+    # moves past whitespace. returns the next char, "" at the end
+    def peek(self):
+        while True:
+            text, pos = self.text, self.pos
+            while pos < len(text) and text[pos] in _WHITESPACE:
+                pos += 1
+            self.pos = pos
+            if pos < len(text):
+                return text[pos]
+            if not self.fill():
+                return ""
+
+    # whether the decode error e may only mean that the value goes on past the buffer
+    def cut_short(self, e):
+        return e.pos >= len(self.text) - _CUT_SHORT or e.msg.startswith("Unterminated string")
+
+    # decodes the JSON value at the current position (after peek), reading more of the
+    # stream until it is complete
+    def decode(self):
+        while True:
+            try:
+                doc, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError as e:
+                # the document may continue in the next read, but only if it failed where the
+                # buffer ends: an error before that is in the body, and reading on would pull
+                # the rest of the stream into memory to report it
+                if self.cut_short(e) and self.fill():
+                    continue
+                raise BadRequest("invalid JSON: %s" % e.msg)
+            # a scalar ending near the end of the buffer might be cut short (eg 1.5e-3 read as 1)
+            if end >= len(self.text) - _CUT_SHORT and not isinstance(doc, (dict, list)) and self.fill():
+                continue
+            self.pos = end
+            return doc
+
+    # Moves to the next item of the array or object being read, just after its opening
+    # bracket when first is set and after an item otherwise: past exactly one ',' between
+    # items, and none before the first. Returns False, having consumed closing, at its end
+    def next_item(self, closing, first):
+        kind = "array" if closing == "]" else "object"
+        ch = self.peek()
+        if ch == closing:
+            self.pos += 1
+            return False
+        if not first:
+            if ch == ",":
+                self.pos += 1
+                ch = self.peek()
+                if ch == closing:
+                    raise BadRequest("invalid JSON: trailing ',' in %s" % kind)
+            elif ch != "":
+                raise BadRequest("invalid JSON: expected ',' or '%s' in %s" % (closing, kind))
+        if ch == "":
+            raise BadRequest("invalid JSON: unterminated %s" % kind)
+        if ch == ",":
+            raise BadRequest("invalid JSON: expected a value before ',' in %s" % kind)
+        return True
+
+    # the items of the array whose [ was just consumed, up to and including its ]
+    def items(self):
+        first = True
+        while self.next_item("]", first):
+            first = False
+            yield self.decode()
+
+    def expect_end(self, closing):
+        if self.peek() != "":
+            raise BadRequest("invalid JSON: data after the closing %s" % closing)
+
+
+# stream is any object with a read(n) method returning bytes (request.stream, an open file)
+# raise BadRequest() if the body is not valid JSON
+def iter_json_docs(stream, read_size=READ_SIZE):
+    buf = _Buffer(stream, read_size)
+    yield from _iter_docs(buf)
+
+
+# The documents of iter_json_docs as an iterable that keeps the message of the BadRequest
+# that ended it in error, for consumers such as DB.add_albums that stop on it without
+# raising
+class JSONDocs:
+    def __init__(self, stream, read_size=READ_SIZE):
+        self.stream = stream
+        self.read_size = read_size
+        self.error = None
+
+    def __iter__(self):
+        try:
+            yield from iter_json_docs(self.stream, self.read_size)
+        except BadRequest as e:
+            self.error = e.message
+            raise
+
+
+def _iter_docs(buf):
+    if buf.peek() == "[":
+        buf.pos += 1
+        yield from buf.items()
+        buf.expect_end("]")
+        return
+    while buf.peek() != "":
+        yield buf.decode()
+
+
+# Items of the `key` array of a stream holding one JSON object (such as the client's test
+# files, {"post_path": ..., "response": ..., "values": [...]}), read one at a time like
+# iter_json_docs; the object's other members are read and skipped. A stream holding an
+# array yields its items. Newline delimited objects look like a single object from their
+# first byte, read them with iter_json_docs
+def iter_json_values(stream, key="values", read_size=READ_SIZE):
+    buf = _Buffer(stream, read_size)
+    if buf.peek() != "{":
+        yield from _iter_docs(buf)
+        return
+    buf.pos += 1
+    first = True
+    while buf.next_item("}", first):
+        first = False
+        name = buf.decode()
+        if not isinstance(name, str) or buf.peek() != ":":
+            raise BadRequest("invalid JSON: expected a member name and ':'")
+        buf.pos += 1
+        if buf.peek() == "[" and name == key:
+            buf.pos += 1
+            yield from buf.items()
+        else:
+            buf.decode()
+    buf.expect_end("}")
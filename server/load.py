@@ -0,0 +1,167 @@
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+from db import DB, BadRequest
+from jsonstream import iter_json_docs, iter_json_values
+from queries import QUERIES
+
+# Builds a database from album data files without the server, for seeding and for
+# rebuilding staging databases.
+#
+# Each file is either in the client's test format ({"post_path": "album", "values": [...]},
+# eg data/full/add-fullalbum.json), a JSON array of albums, or newline delimited JSON with
+# one album per line (files named *.ndjson or *.jsonl). Files are read as a stream, so the
+# albums of a file are never all in memory at once.
+#
+# The database is built in <database>.loading and moved over <database> only when the
+# load is complete, so a failed load leaves the previous database alone:
+#  - the schema comes from schema/create.sql
+#  - fsync is off, the rollback journal is kept in memory and the page cache is large
+#    while loading, since a crash only loses the file being built. The journal stays on
+#    (MEMORY, not OFF) because add_albums rolls a failed album back to its savepoint
+#  - albums go through DB.add_albums, the same validation and inserts as POST /albums/bulk,
+#    committing every --chunk-size albums
+#  - the secondary indexes and the triggers of create.sql are dropped before the load and
+#    created again after it, with artist_stats filled in one GROUP BY instead of one upsert
+#    per song_artist row, and name_search in one INSERT ... SELECT
+#  - album.solo is set for every album in one UPDATE after the indexes are created, instead
+#    of after each album (see update_solo in queries.py)
+#
+# from the server directory:
+#   python3 load.py ../data/full/add-fullalbum.json           (builds splatDB.sqlite3)
+#   python3 load.py -d staging.sqlite3 albums-*.ndjson
+
+CREATE_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema", "create.sql")
+
+# pragmas of the connection building the database. cache_size is negative so it is in KiB
+LOAD_PRAGMAS = {
+    "journal_mode": "MEMORY",
+    "synchronous": "OFF",
+    "locking_mode": "EXCLUSIVE",
+    "cache_size": -256 * 1024,
+    "temp_store": "MEMORY",
+}
+
+# what the artist_stats trigger would have added up, as in schema/migrations/002_artist_stats.sql
+FILL_ARTIST_STATS = """INSERT INTO artist_stats (artist_id, song_count, total_length)
+    SELECT artist_id, count(length), coalesce(sum(length), 0)
+    FROM song_artist NATURAL JOIN song GROUP BY artist_id"""
+
+# what the name_search triggers would have added, as in schema/migrations/005_name_search.sql
+FILL_NAME_SEARCH = """INSERT INTO name_search (name, kind, id)
+    SELECT song_name, 'song', song_id FROM song
+    UNION ALL SELECT album_name, 'album', album_id FROM album
+    UNION ALL SELECT artist_name, 'artist', artist_id FROM artist"""
+
+TABLES = ("album", "artist", "song", "song_artist", "song_album", "artist_album", "artist_stats")
+
+
+# The albums of every file in paths, one at a time. DB.add_albums stops at a file that is
+# not valid JSON but keeps what it loaded; error is set then so the load can be abandoned
+class AlbumFiles:
+    def __init__(self, paths):
+        self.paths = paths
+        self.error = None
+
+    def __iter__(self):
+        for path in self.paths:
+            with open(path, "rb") as f:
+                try:
+                    if path.endswith((".ndjson", ".jsonl")):
+                        yield from iter_json_docs(f)
+                    else:
+                        yield from iter_json_values(f)
+                except BadRequest as e:
+                    self.error = "%s: %s" % (path, e.message)
+                    raise
+
+
+# drops the secondary indexes and triggers of the schema and returns their SQL, in the
+# order they have to be created again (indexes first)
+def drop_deferred(conn):
+    rows = conn.execute("""SELECT type, name, sql FROM sqlite_master
+        WHERE type IN ('index', 'trigger') AND sql IS NOT NULL
+        ORDER BY type = 'trigger', rowid""").fetchall()
+    for object_type, name, sql in rows:
+        conn.execute("DROP %s %s" % (object_type.upper(), name))
+    return [sql for object_type, name, sql in rows]
+
+
+# Creates the schema in a new database at path and loads the albums into it.
+# Returns {"albums", "failed", "errors", "rows": {table: count}, "load_seconds", "index_seconds"};
+# errors are the entries of DB.add_albums for the albums that were not inserted
+def build(path, albums, chunk_size=5000, create_file=CREATE_SQL):
+    conn = sqlite3.connect(path)
+    try:
+        for name, value in LOAD_PRAGMAS.items():
+            conn.execute("PRAGMA %s = %s" % (name, value))
+        db = DB(conn)
+        db.defer_solo = True
+        db.create_db(create_file)
+        deferred = drop_deferred(conn)
+        conn.commit()
+
+        started = time.perf_counter()
+        res = db.add_albums(albums, chunk_size=chunk_size)
+        loaded = time.perf_counter()
+
+        conn.execute("BEGIN")
+        conn.execute(FILL_ARTIST_STATS)
+        conn.execute(FILL_NAME_SEARCH)
+        for sql in deferred:
+            conn.execute(sql)
+        # reads artist_album by album_id, so only once artist_album_by_album is back
+        conn.execute(QUERIES.sql("update_solo_all"))
+        conn.commit()
+        indexed = time.perf_counter()
+
+        rows = {table: conn.execute("SELECT count(*) FROM %s" % table).fetchone()[0] for table in TABLES}
+    finally:
+        conn.close()
+    return {"albums": res["inserted"], "failed": res["failed"], "errors": res["errors"], "rows": rows,
+            "load_seconds": loaded - started, "index_seconds": indexed - loaded}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", help="album files (.json, or .ndjson/.jsonl for one album per line)", nargs="+")
+    parser.add_argument("-d", "--database", help="database file (default splatDB.sqlite3)", default="splatDB.sqlite3")
+    parser.add_argument("--chunk-size", help="albums per transaction (default 5000)", default=5000, type=int)
+    config = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    building = config.database + ".loading"
+    if os.path.exists(building):
+        os.remove(building)
+    source = AlbumFiles(config.files)
+    try:
+        res = build(building, source, config.chunk_size)
+        if source.error:
+            raise ValueError(source.error)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        if os.path.exists(building):
+            os.remove(building)
+        sys.exit("load failed: %s" % e)
+
+    for error in res["errors"][:20]:
+        print("album %d (id %s) not loaded: %s" % (error["index"], error["album_id"], error["message"]))
+    if res["failed"] > 20:
+        print("... and %d more" % (res["failed"] - 20))
+    # the -wal/-shm of the old database would be replayed onto the new one. stop any server
+    # using the database before loading over it
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(config.database + suffix):
+            os.remove(config.database + suffix)
+    os.replace(building, config.database)
+
+    total_rows = sum(res["rows"].values())
+    seconds = res["load_seconds"] + res["index_seconds"]
+    print("Loaded %d albums (%d failed) into %s" % (res["albums"], res["failed"], config.database))
+    print("  " + ", ".join("%s %d" % item for item in res["rows"].items()))
+    print("  %d rows in %.2f s: %.0f rows/s (insert %.2f s, indexes and stats %.2f s)"
+          % (total_rows, seconds, total_rows / seconds if seconds else 0,
+             res["load_seconds"], res["index_seconds"]))
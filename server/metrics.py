@@ -0,0 +1,116 @@
+import bisect
+import threading
+
+# Latency histograms for the /metrics endpoint, in the Prometheus text format
+# (https://prometheus.io/docs/instrumenting/exposition_formats/).
+#
+# app.py observes every request under its route rule (eg /songs/<song_id>, not
+# the URL, so the number of series stays bounded) and queries.py observes every
+# registered SQL statement. Both are skipped when instrumentation is off.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# upper bounds in seconds. Lookups here take well under a millisecond, so the
+# low end is finer than the usual Prometheus defaults
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    # not locked, callers hold their own lock
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # [(le, cumulative count)] ending with ("+Inf", count)
+    def cumulative(self):
+        res = []
+        total = 0
+        for le, n in zip(self.buckets + ("+Inf",), self.counts):
+            total += n
+            res.append((le, total))
+        return res
+
+
+# histograms of one metric, one per set of label values
+class HistogramFamily:
+    def __init__(self, name, help_text, label_names, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self._series = {}  # label values -> Histogram
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            hist = self._series.get(label_values)
+            if hist is None:
+                hist = self._series[label_values] = Histogram(self.buckets)
+            hist.observe(value)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help_text), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            series = sorted((values, list(hist.cumulative()), hist.sum, hist.count)
+                            for values, hist in self._series.items())
+        for values, cumulative, total, count in series:
+            labels = list(zip(self.label_names, values))
+            for le, n in cumulative:
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(labels + [("le", format_le(le))]), n))
+            lines.append("%s_sum%s %r" % (self.name, format_labels(labels), total))
+            lines.append("%s_count%s %d" % (self.name, format_labels(labels), count))
+        return lines
+
+
+# lines for single valued metrics, kind is "counter" or "gauge"
+def render_value(name, kind, help_text, value):
+    return ["# HELP %s %s" % (name, help_text), "# TYPE %s %s" % (name, kind), "%s %r" % (name, value)]
+
+
+def format_le(le):
+    return le if isinstance(le, str) else repr(float(le))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, escape(str(value))) for name, value in labels)
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+REQUEST_SECONDS = HistogramFamily("splatify_request_duration_seconds",
+                                  "Time to build the response of a request, by route.",
+                                  ("method", "route", "status"))
+QUERY_SECONDS = HistogramFamily("splatify_query_duration_seconds",
+                                "Time spent executing a registered SQL statement (see queries.py).",
+                                ("query",))
+
+
+# the whole /metrics page. cache is the lookup cache.LRUCache or None
+def render(cache=None):
+    lines = REQUEST_SECONDS.render() + QUERY_SECONDS.render()
+    if cache is not None:
+        stats = cache.stats()
+        lines += render_value("splatify_cache_hits_total", "counter", "Lookup cache hits.", stats["hits"])
+        lines += render_value("splatify_cache_misses_total", "counter", "Lookup cache misses.", stats["misses"])
+        lines += render_value("splatify_cache_evictions_total", "counter",
+                              "Entries evicted from the lookup cache.", stats["evictions"])
+        lines += render_value("splatify_cache_invalidations_total", "counter",
+                              "Entries dropped from the lookup cache by writes.", stats["invalidations"])
+        lines += render_value("splatify_cache_entries", "gauge", "Entries in the lookup cache.", stats["size"])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,65 @@
+import argparse
+import os
+import re
+import sqlite3
+
+# Brings an existing database up to the current schema without dropping data.
+# Fresh databases built from schema/create.sql are already current.
+#
+# Every file in schema/migrations is named NNN_description.sql. The schema version
+# of a database is kept in PRAGMA user_version; running this applies each migration
+# newer than that version in its own transaction and records the new version.
+#
+# from the server directory:
+#   python3 migrate.py                 (migrates splatDB.sqlite3)
+#   python3 migrate.py -d other.sqlite3
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema", "migrations")
+
+
+# returns [(version, path)] for every migration file, in order
+def list_migrations(migrations_dir=MIGRATIONS_DIR):
+    res = []
+    for name in os.listdir(migrations_dir):
+        m = re.match(r"^(\d+)_.*\.sql$", name)
+        if m:
+            res.append((int(m.group(1)), os.path.join(migrations_dir, name)))
+    return sorted(res)
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+# applies pending migrations and returns the list of versions applied
+def migrate(conn, migrations_dir=MIGRATIONS_DIR):
+    applied = []
+    for version, migration_file in list_migrations(migrations_dir):
+        if version <= schema_version(conn):
+            continue
+        with open(migration_file, "r") as f:
+            script = f.read()
+        # executescript commits anything pending first, then runs the script as-is.
+        # wrapping it makes the migration and the version bump atomic
+        try:
+            conn.executescript("BEGIN;\n%s\nPRAGMA user_version = %d;\nCOMMIT;" % (script, version))
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--database", help="database file (default splatDB.sqlite3)", default="splatDB.sqlite3")
+    config = parser.parse_args()
+
+    conn = sqlite3.connect(config.database)
+    before = schema_version(conn)
+    applied = migrate(conn)
+    if applied:
+        print("Migrated %s from version %d to %d" % (config.database, before, applied[-1]))
+    else:
+        print("%s is up to date (version %d)" % (config.database, before))
+    conn.close()
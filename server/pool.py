@@ -0,0 +1,138 @@
+import os
+import queue
+import sqlite3
+import threading
+import urllib.parse
+
+# Process-wide pool of SQLite connections, so requests stop paying for
+# sqlite3.connect (and the schema parse that comes with it) every time.
+#
+# Readers come from a pool of `size` connections and run concurrently.
+# There is a single writer connection, handed to one request at a time:
+# with WAL journaling the readers keep going while it writes.
+
+# pragmas run on every new connection. cache_size is negative so it is in KiB
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+# compiled statements kept by each connection, keyed by SQL text (sqlite3's default is 128).
+# well above the number of statements in queries.py, so ad hoc SQL from /web/query
+# does not push them out
+STATEMENT_CACHE_SIZE = 256
+
+
+# read_only connections are opened with mode=ro and query_only on, and their authorizer
+# refuses ATTACH, DETACH and setting pragmas, so SQL run on them cannot write or undo that
+def connect(database, pragmas=None, timeout=5.0, read_only=False):
+    if read_only:
+        uri = "file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(database))
+        conn = sqlite3.connect(uri, timeout=timeout, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE, uri=True)
+    else:
+        conn = sqlite3.connect(database, timeout=timeout, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+    for name, value in (pragmas or DEFAULT_PRAGMAS).items():
+        # the journal mode is the database's, a read only connection cannot set it
+        if read_only and name == "journal_mode":
+            continue
+        conn.execute("PRAGMA %s = %s" % (name, value))
+    if read_only:
+        conn.execute("PRAGMA query_only = ON")
+        conn.set_authorizer(_read_only_authorizer)
+    return conn
+
+
+def _read_only_authorizer(action, arg1, arg2, db_name, trigger):
+    if action in (sqlite3.SQLITE_ATTACH, sqlite3.SQLITE_DETACH):
+        return sqlite3.SQLITE_DENY
+    # arg2 is the value of `PRAGMA name = value`, None when the pragma is only read
+    if action == sqlite3.SQLITE_PRAGMA and arg2 is not None:
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
+
+# with read_only=True every connection of the pool is read only (see connect), and
+# there is no writer
+class ConnectionPool:
+    def __init__(self, database, size=8, pragmas=None, timeout=5.0, read_only=False):
+        self.database = database
+        self.size = size
+        self.pragmas = dict(DEFAULT_PRAGMAS, **(pragmas or {}))
+        self.timeout = timeout
+        self.read_only = read_only
+        self._readers = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def _connect(self):
+        return connect(self.database, self.pragmas, self.timeout, self.read_only)
+
+    # returns a reader connection, waiting up to timeout seconds when all are in use.
+    # raise sqlite3.OperationalError if none frees up in time
+    def acquire(self):
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except sqlite3.Error:
+                    self._created -= 1
+                    raise
+        try:
+            return self._readers.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("connection pool exhausted")
+
+    def release(self, conn):
+        _reset(conn)
+        self._readers.put(conn)
+
+    # returns the writer connection once no other request holds it.
+    # raise sqlite3.OperationalError if it is not freed within timeout seconds
+    def acquire_writer(self):
+        if self.read_only:
+            raise sqlite3.OperationalError("read only connection pool has no writer")
+        if not self._writer_lock.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError("database is locked by another writer")
+        try:
+            if self._writer is None:
+                self._writer = self._connect()
+        except sqlite3.Error:
+            self._writer_lock.release()
+            raise
+        return self._writer
+
+    def release_writer(self, conn):
+        try:
+            _reset(conn)
+        finally:
+            self._writer_lock.release()
+
+    def close(self):
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        self._created = 0
+
+
+# a connection goes back to the pool with no transaction left open
+def _reset(conn):
+    if conn.in_transaction:
+        conn.rollback()
@@ -0,0 +1,285 @@
+import threading
+import time
+
+from metrics import QUERY_SECONDS
+
+# Registry of the named, parameterized SQL statements the DB class runs.
+#
+# sqlite3 keeps a cache of compiled statements on each connection, keyed by the
+# SQL text (sqlite3.connect's cached_statements, see pool.py). Every lookup runs
+# its registered text unchanged, so on a pooled connection each statement is
+# compiled the first time it is used and reused from then on.
+#
+# The registry also counts executions per statement and times them, which is
+# what /queries/stats reports, and feeds the query histogram of /metrics. The
+# time is spent in cursor.execute: for SQLite that is running the statement up to
+# its first row, which includes any sort. Reading the remaining rows of a cursor
+# afterwards is not timed, except through fetchall() below.
+# With enabled = False statements run untimed and nothing is recorded.
+#
+# Each method also takes an optional slowlog.SlowQueryLog, which is given every
+# statement's duration whether or not the registry is enabled.
+
+
+class QueryRegistry:
+    def __init__(self):
+        self._sql = {}
+        self._stats = {}  # name -> [calls, rows, total seconds, max seconds]
+        self._lock = threading.Lock()
+        self.enabled = True
+
+    # registers sql under name and returns name. names are unique
+    def register(self, name, sql):
+        if name in self._sql:
+            raise ValueError("query %s is already registered" % name)
+        self._sql[name] = sql
+        self._stats[name] = [0, 0, 0.0, 0.0]
+        return name
+
+    # registers a keyset paginated query (see db.page_query) as two statements:
+    # name without an `after` cursor and name + "_after" with it. sql has a %s where
+    # the cursor condition goes, and `:limit` is always bound (-1 is no limit)
+    def register_paged(self, name, sql, column):
+        self.register(name, sql % "")
+        self.register(name + "_after", sql % (" AND %s > :after" % column))
+        return name
+
+    # registers sql under name unless that name is already registered, for statements on
+    # tables created at run time (the monthly play tables, see db.play_partition)
+    def ensure(self, name, sql):
+        with self._lock:
+            if name not in self._sql:
+                self._stats[name] = [0, 0, 0.0, 0.0]
+                self._sql[name] = sql
+        return name
+
+    def sql(self, name):
+        return self._sql[name]
+
+    def names(self):
+        return list(self._sql)
+
+    # runs the statement called name on cursor and returns the cursor
+    def execute(self, cursor, name, params=(), slow_log=None):
+        sql = self._sql[name]
+        if not self.enabled and slow_log is None:
+            return cursor.execute(sql, params)
+        start = time.perf_counter()
+        try:
+            return cursor.execute(sql, params)
+        finally:
+            seconds = time.perf_counter() - start
+            self._record(name, seconds, 0)
+            if slow_log is not None:
+                slow_log.check(cursor.connection, name, sql, params, seconds)
+
+    # runs the statement once per set of parameters in seq_of_params (a list)
+    def executemany(self, cursor, name, seq_of_params, slow_log=None):
+        sql = self._sql[name]
+        if not self.enabled and slow_log is None:
+            return cursor.executemany(sql, seq_of_params)
+        start = time.perf_counter()
+        try:
+            return cursor.executemany(sql, seq_of_params)
+        finally:
+            seconds = time.perf_counter() - start
+            self._record(name, seconds, max(cursor.rowcount, 0))
+            if slow_log is not None:
+                slow_log.check_many(cursor.connection, name, sql, seq_of_params, seconds)
+
+    # runs the statement and returns all its rows, timing the fetch too
+    def fetchall(self, cursor, name, params=(), slow_log=None):
+        sql = self._sql[name]
+        if not self.enabled and slow_log is None:
+            return cursor.execute(sql, params).fetchall()
+        start = time.perf_counter()
+        rows = []
+        try:
+            rows = cursor.execute(sql, params).fetchall()
+            return rows
+        finally:
+            seconds = time.perf_counter() - start
+            self._record(name, seconds, len(rows))
+            if slow_log is not None:
+                slow_log.check(cursor.connection, name, sql, params, seconds)
+
+    def _record(self, name, seconds, rows):
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._stats[name]
+            stats[0] += 1
+            stats[1] += rows
+            stats[2] += seconds
+            if seconds > stats[3]:
+                stats[3] = seconds
+        QUERY_SECONDS.observe((name,), seconds)
+
+    # {name: {"calls", "rows", "total_ms", "mean_ms", "max_ms"}} for every statement run
+    # at least once, slowest total first
+    def stats(self):
+        with self._lock:
+            snapshot = [(name, list(stats)) for name, stats in self._stats.items() if stats[0]]
+        snapshot.sort(key=lambda item: item[1][2], reverse=True)
+        res = {}
+        for name, (calls, rows, total, longest) in snapshot:
+            res[name] = {"calls": calls, "rows": rows,
+                         "total_ms": round(total * 1000, 3),
+                         "mean_ms": round(total * 1000 / calls, 3),
+                         "max_ms": round(longest * 1000, 3)}
+        return res
+
+    def reset(self):
+        with self._lock:
+            for stats in self._stats.values():
+                stats[:] = [0, 0, 0.0, 0.0]
+        QUERY_SECONDS.clear()
+
+
+QUERIES = QueryRegistry()
+register = QUERIES.register
+
+# -----------------
+# album ingest, one INSERT OR IGNORE per table so re-posting an album
+# (or a song/artist shared between albums) does not fail
+# -----------------
+register("insert_album", "INSERT OR IGNORE INTO album (album_id, album_name, release_year) VALUES (?, ?, ?)")
+register("insert_artist", "INSERT OR IGNORE INTO artist (artist_id, artist_name, country) VALUES (?, ?, ?)")
+register("insert_song", "INSERT OR IGNORE INTO song (song_id, song_name, length) VALUES (?, ?, ?)")
+register("insert_song_artist", "INSERT OR IGNORE INTO song_artist (song_id, artist_id) VALUES (?, ?)")
+register("insert_song_album",
+         "INSERT OR IGNORE INTO song_album (song_id, album_id, order_in_album) VALUES (?, ?, ?)")
+register("insert_artist_album", "INSERT OR IGNORE INTO artist_album (artist_id, album_id) VALUES (?, ?)")
+
+# -----------------
+# songs
+# -----------------
+register("song_by_id", "SELECT song_id, song_name, length FROM song WHERE song_id = :song_id")
+register("song_artist_ids", "SELECT artist_id FROM song_artist WHERE song_id = :song_id ORDER BY artist_id")
+register("song_album_ids", "SELECT album_id FROM song_album WHERE song_id = :song_id ORDER BY album_id")
+
+# batch lookups (see DB.find_songs): the ids are bound as one JSON array (:ids) and
+# read with json_each, as for the plays, so one statement serves any number of ids
+IDS = "(SELECT value FROM json_each(:ids))"
+register("songs_by_ids", "SELECT song_id, song_name, length FROM song WHERE song_id IN " + IDS)
+register("songs_artist_ids", """SELECT song_id, artist_id FROM song_artist
+    WHERE song_id IN %s ORDER BY song_id, artist_id""" % IDS)
+register("songs_album_ids", """SELECT song_id, album_id FROM song_album
+    WHERE song_id IN %s ORDER BY song_id, album_id""" % IDS)
+
+# one row per (song, artist) in album order; songs are regrouped in db.iter_songs_with_artists
+QUERIES.register_paged("songs_by_album", """SELECT order_in_album, song_id, song_name, length, artist_id
+    FROM (SELECT order_in_album, song_id FROM song_album
+          WHERE album_id = :album_id%s ORDER BY order_in_album LIMIT :limit)
+    NATURAL JOIN song LEFT JOIN song_artist USING (song_id)
+    ORDER BY order_in_album, artist_id""", "order_in_album")
+
+# one row per (song, artist of that song), ordered by song_id
+QUERIES.register_paged("songs_by_artist", """SELECT s.song_id, s.song_id, s.song_name, s.length, other.artist_id
+    FROM (SELECT song_id FROM song_artist
+          WHERE artist_id = :artist_id%s ORDER BY song_id LIMIT :limit) AS sa
+    JOIN song AS s ON s.song_id = sa.song_id
+    JOIN song_artist AS other ON other.song_id = s.song_id
+    ORDER BY s.song_id, other.artist_id""", "song_id")
+
+# -----------------
+# albums
+# -----------------
+register("album_by_id", "SELECT album_id, album_name, release_year FROM album WHERE album_id = :album_id")
+register("album_exists", "SELECT album_id FROM album WHERE album_id = :album_id")
+register("album_artist_ids", "SELECT artist_id FROM artist_album WHERE album_id = :album_id ORDER BY artist_id")
+register("album_song_ids", "SELECT song_id FROM song_album WHERE album_id = :album_id ORDER BY order_in_album")
+# every artist of an album or of one of its songs, for DB.find_album_full
+register("album_all_artists", """SELECT artist_id, artist_name, country FROM artist
+    WHERE artist_id IN (SELECT artist_id FROM artist_album WHERE album_id = :album_id
+        UNION SELECT artist_id FROM song_album NATURAL JOIN song_artist WHERE album_id = :album_id)
+    ORDER BY artist_id""")
+register("albums_by_ids", "SELECT album_id, album_name, release_year FROM album WHERE album_id IN " + IDS)
+register("albums_artist_ids", """SELECT album_id, artist_id FROM artist_album
+    WHERE album_id IN %s ORDER BY album_id, artist_id""" % IDS)
+register("albums_song_ids", """SELECT album_id, song_id FROM song_album
+    WHERE album_id IN %s ORDER BY album_id, order_in_album""" % IDS)
+
+QUERIES.register_paged("albums_by_artist", """SELECT album_id, album_name, release_year
+    FROM artist_album NATURAL JOIN album
+    WHERE artist_id = :artist_id%s ORDER BY album_id LIMIT :limit""", "album_id")
+
+# -----------------
+# artists
+# -----------------
+register("artist_by_id", "SELECT artist_id, artist_name, country FROM artist WHERE artist_id = :artist_id")
+register("artist_exists", "SELECT artist_id FROM artist WHERE artist_id = :artist_id")
+register("artists_by_ids", "SELECT artist_id, artist_name, country FROM artist WHERE artist_id IN " + IDS)
+
+# -----------------
+# analytics
+# -----------------
+# point lookup in the running totals (artist_stats), which also checks the artist exists.
+# an artist without songs gets nulls, as avg() over no rows did
+register("avg_song_length", """SELECT stats.artist_id, ROUND(1.0 * total_length / song_count, 1) AS avg_length
+    FROM artist LEFT JOIN artist_stats AS stats USING (artist_id)
+    WHERE artist_id = :artist_id""")
+
+# reads the first rows of the artist_stats total_length index
+register("top_length", """SELECT artist_id, total_length FROM artist_stats NATURAL JOIN artist
+    ORDER BY total_length DESC, artist_id LIMIT :n""")
+
+# album.solo: 1 for an album with a single artist whose songs are credited to that
+# artist alone (see schema/migrations/004_solo_albums.sql). After an album insert the
+# flag is recomputed for the album, and when the post added artists to songs that were
+# already there, for every album sharing a song with it (:song_ids, a JSON array; see
+# db.insert_album_rows). update_solo_all recomputes every album, for load.py
+SOLO = """(SELECT count(*) FROM artist_album AS aa WHERE aa.album_id = album.album_id) = 1
+    AND NOT EXISTS (SELECT 1 FROM song_album AS sa JOIN song_artist AS s USING (song_id)
+        WHERE sa.album_id = album.album_id AND s.artist_id NOT IN
+            (SELECT artist_id FROM artist_album AS aa WHERE aa.album_id = album.album_id))"""
+register("update_solo", """UPDATE album SET solo = (%s)
+    WHERE album_id IN (SELECT :album_id UNION
+        SELECT album_id FROM song_album WHERE song_id IN (SELECT value FROM json_each(:song_ids)))""" % SOLO)
+register("update_solo_album", "UPDATE album SET solo = (%s) WHERE album_id = :album_id" % SOLO)
+register("update_solo_all", "UPDATE album SET solo = (%s)" % SOLO)
+
+# reads the album_solo partial index
+register("solo_albums", """SELECT album_id, album_name, release_year FROM album
+    WHERE solo = 1 ORDER BY album_id""")
+
+# -----------------
+# name search (see DB.search). :match is an FTS5 query from db.search_match.
+# rank is bm25; ordering by it alone lets FTS5 sort the matches itself
+# and read the columns of only the rows returned
+# -----------------
+register("search", """SELECT kind, id, name FROM name_search
+    WHERE name_search MATCH :match ORDER BY rank LIMIT :n""")
+register("flush_names", "INSERT INTO name_search (name, kind, id) SELECT name, kind, id FROM name_search_pending")
+register("clear_pending_names", "DELETE FROM name_search_pending")
+
+# -----------------
+# plays (see DB.add_plays). Lists of ids or names are bound as one JSON array
+# and read with json_each, so each statement has a single text whatever the batch size
+# -----------------
+register("songs_existing", "SELECT song_id FROM song WHERE song_id IN (SELECT value FROM json_each(:ids))")
+register("insert_play_country", "INSERT OR IGNORE INTO play_country (country) VALUES (?)")
+register("play_country_ids", """SELECT country, country_id FROM play_country
+    WHERE country IN (SELECT value FROM json_each(:names))""")
+register("insert_play_source", "INSERT OR IGNORE INTO play_source (source) VALUES (?)")
+register("play_source_ids", """SELECT source, source_id FROM play_source
+    WHERE source IN (SELECT value FROM json_each(:names))""")
+
+# adding a batch's counts to the daily rollups
+register("add_play_song_daily", """INSERT INTO play_song_daily (day, song_id, plays) VALUES (?, ?, ?)
+    ON CONFLICT (day, song_id) DO UPDATE SET plays = plays + excluded.plays""")
+register("add_play_country_daily", """INSERT INTO play_country_daily (day, country_id, plays) VALUES (?, ?, ?)
+    ON CONFLICT (day, country_id) DO UPDATE SET plays = plays + excluded.plays""")
+register("add_play_source_daily", """INSERT INTO play_source_daily (day, song_id, source_id, plays) VALUES (?, ?, ?, ?)
+    ON CONFLICT (day, song_id, source_id) DO UPDATE SET plays = plays + excluded.plays""")
+
+# reads the first rows of the day in the play_song_daily plays index
+register("top_song", """SELECT song_id, song_name, plays AS play_count
+    FROM play_song_daily AS d JOIN song USING (song_id)
+    WHERE d.day = :day ORDER BY d.plays DESC, d.song_id LIMIT :n""")
+register("top_country", """SELECT country, plays AS play_count
+    FROM play_country_daily NATURAL JOIN play_country
+    WHERE day = :day ORDER BY plays DESC, country LIMIT :n""")
+register("top_source", """SELECT source, plays AS play_count
+    FROM play_source_daily NATURAL JOIN play_source
+    WHERE day = :day AND song_id = :song_id ORDER BY plays DESC, source""")
@@ -4,11 +4,22 @@ DROP TABLE IF EXISTS song;
 DROP TABLE IF EXISTS song_artist;
 DROP TABLE IF EXISTS song_album;
 DROP TABLE IF EXISTS artist_album;
+DROP TABLE IF EXISTS artist_stats;
+DROP TABLE IF EXISTS play_country;
+DROP TABLE IF EXISTS play_source;
+DROP TABLE IF EXISTS play_song_daily;
+DROP TABLE IF EXISTS play_country_daily;
+DROP TABLE IF EXISTS play_source_daily;
+DROP TABLE IF EXISTS name_search;
+DROP TABLE IF EXISTS name_search_pending;
 
 CREATE TABLE album (
     album_id INT,
     album_name VARCHAR(40) NOT NULL,
     release_year YEAR,
+    -- 1 for an album by a single artist whose songs are credited to that artist alone,
+    -- kept up to date by DB.add_album (see update_solo in queries.py)
+    solo INT NOT NULL DEFAULT 0,
     PRIMARY KEY (album_id)
 );
 
@@ -39,12 +50,113 @@ CREATE TABLE song_album (
     album_id INT NOT NULL,
     order_in_album INT NOT NULL,
     FOREIGN KEY (album_id) REFERENCES album,
-    FOREIGN KEY (song_id) REFERENCES song
-);
+    FOREIGN KEY (song_id) REFERENCES song,
+    PRIMARY KEY (album_id, order_in_album)
+) WITHOUT ROWID;
 
 CREATE TABLE artist_album (
     artist_id INT NOT NULL,
     album_id INT NOT NULL,
     FOREIGN KEY (artist_id) REFERENCES artist,
-    FOREIGN KEY (album_id) REFERENCES album
+    FOREIGN KEY (album_id) REFERENCES album,
+    PRIMARY KEY (artist_id, album_id)
+) WITHOUT ROWID;
+
+-- lookup paths not served by a primary key
+CREATE INDEX song_artist_by_artist ON song_artist (artist_id, song_id);
+CREATE INDEX song_album_by_song ON song_album (song_id, album_id);
+CREATE INDEX artist_album_by_album ON artist_album (album_id, artist_id);
+-- only the solo albums, in album_id order, for /analytics/solo_albums
+CREATE INDEX album_solo ON album (album_id) WHERE solo = 1;
+
+-- per-artist running totals over the songs linked to the artist in song_artist,
+-- kept up to date by the trigger below. song_count only counts songs with a length
+CREATE TABLE artist_stats (
+    artist_id INT NOT NULL,
+    song_count INT NOT NULL,
+    total_length INT NOT NULL,
+    PRIMARY KEY (artist_id)
+) WITHOUT ROWID;
+
+CREATE INDEX artist_stats_by_total_length ON artist_stats (total_length DESC, artist_id);
+
+-- fires only for rows actually inserted, so INSERT OR IGNORE duplicates are not counted twice
+CREATE TRIGGER song_artist_stats AFTER INSERT ON song_artist
+BEGIN
+    INSERT INTO artist_stats (artist_id, song_count, total_length)
+        SELECT NEW.artist_id, count(length), coalesce(sum(length), 0) FROM song WHERE song_id = NEW.song_id
+        ON CONFLICT (artist_id) DO UPDATE SET song_count = song_count + excluded.song_count,
+                                              total_length = total_length + excluded.total_length;
+END;
+
+-- full-text index of song, album and artist names for /search (see DB.search).
+-- kind is 'song', 'album' or 'artist' and id the row's key. prefix keeps the 2 and 3
+-- character prefixes of every word so short prefix queries read one term
+CREATE VIRTUAL TABLE name_search USING fts5(name, kind UNINDEXED, id UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3');
+
+-- names inserted since the last commit. The triggers below add them here as rows are
+-- inserted, so INSERT OR IGNORE duplicates are not indexed twice, and DB.flush_names
+-- moves them into name_search in one statement just before each commit: FTS5 writes
+-- a new index segment at every savepoint, and DB.add_albums has one per album
+CREATE TABLE name_search_pending (
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    id INT NOT NULL
 );
+
+CREATE TRIGGER song_name_search AFTER INSERT ON song
+BEGIN
+    INSERT INTO name_search_pending (name, kind, id) VALUES (NEW.song_name, 'song', NEW.song_id);
+END;
+
+CREATE TRIGGER album_name_search AFTER INSERT ON album
+BEGIN
+    INSERT INTO name_search_pending (name, kind, id) VALUES (NEW.album_name, 'album', NEW.album_id);
+END;
+
+CREATE TRIGGER artist_name_search AFTER INSERT ON artist
+BEGIN
+    INSERT INTO name_search_pending (name, kind, id) VALUES (NEW.artist_name, 'artist', NEW.artist_id);
+END;
+
+-- play events (see DB.add_plays). The raw events go to one append-only table per month,
+-- play_YYYYMM, created on first use and dropped by DB.create_db. Every query is answered
+-- from the daily rollups below, which are added to as the events are written.
+-- day is days since 1970-01-01 (UTC); countries and sources are stored as ids
+CREATE TABLE play_country (
+    country_id INTEGER PRIMARY KEY,
+    country TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE play_source (
+    source_id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE play_song_daily (
+    day INT NOT NULL,
+    song_id INT NOT NULL,
+    plays INT NOT NULL,
+    PRIMARY KEY (day, song_id)
+) WITHOUT ROWID;
+
+CREATE INDEX play_song_daily_by_plays ON play_song_daily (day, plays DESC, song_id);
+
+CREATE TABLE play_country_daily (
+    day INT NOT NULL,
+    country_id INT NOT NULL,
+    plays INT NOT NULL,
+    PRIMARY KEY (day, country_id)
+) WITHOUT ROWID;
+
+CREATE TABLE play_source_daily (
+    day INT NOT NULL,
+    song_id INT NOT NULL,
+    source_id INT NOT NULL,
+    plays INT NOT NULL,
+    PRIMARY KEY (day, song_id, source_id)
+) WITHOUT ROWID;
+
+-- bump together with a new file in schema/migrations (see migrate.py)
+PRAGMA user_version = 5;
@@ -0,0 +1,32 @@
+-- Primary keys for song_album and artist_album (so INSERT OR IGNORE deduplicates them)
+-- and indexes for every lookup path. SQLite cannot add a primary key to an existing
+-- table, so both tables are rebuilt; duplicate rows are dropped on the way.
+
+CREATE TABLE song_album_new (
+    song_id INT NOT NULL,
+    album_id INT NOT NULL,
+    order_in_album INT NOT NULL,
+    FOREIGN KEY (album_id) REFERENCES album,
+    FOREIGN KEY (song_id) REFERENCES song,
+    PRIMARY KEY (album_id, order_in_album)
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO song_album_new (song_id, album_id, order_in_album)
+    SELECT song_id, album_id, order_in_album FROM song_album ORDER BY rowid;
+DROP TABLE song_album;
+ALTER TABLE song_album_new RENAME TO song_album;
+
+CREATE TABLE artist_album_new (
+    artist_id INT NOT NULL,
+    album_id INT NOT NULL,
+    FOREIGN KEY (artist_id) REFERENCES artist,
+    FOREIGN KEY (album_id) REFERENCES album,
+    PRIMARY KEY (artist_id, album_id)
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO artist_album_new (artist_id, album_id)
+    SELECT artist_id, album_id FROM artist_album ORDER BY rowid;
+DROP TABLE artist_album;
+ALTER TABLE artist_album_new RENAME TO artist_album;
+
+CREATE INDEX song_artist_by_artist ON song_artist (artist_id, song_id);
+CREATE INDEX song_album_by_song ON song_album (song_id, album_id);
+CREATE INDEX artist_album_by_album ON artist_album (album_id, artist_id);
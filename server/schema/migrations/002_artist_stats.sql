@@ -0,0 +1,23 @@
+-- Per-artist song count and total length, maintained on insert into song_artist,
+-- so avg_song_length and top_length no longer aggregate over the whole catalog.
+
+CREATE TABLE artist_stats (
+    artist_id INT NOT NULL,
+    song_count INT NOT NULL,
+    total_length INT NOT NULL,
+    PRIMARY KEY (artist_id)
+) WITHOUT ROWID;
+
+INSERT INTO artist_stats (artist_id, song_count, total_length)
+    SELECT artist_id, count(length), coalesce(sum(length), 0)
+    FROM song_artist NATURAL JOIN song GROUP BY artist_id;
+
+CREATE INDEX artist_stats_by_total_length ON artist_stats (total_length DESC, artist_id);
+
+CREATE TRIGGER song_artist_stats AFTER INSERT ON song_artist
+BEGIN
+    INSERT INTO artist_stats (artist_id, song_count, total_length)
+        SELECT NEW.artist_id, count(length), coalesce(sum(length), 0) FROM song WHERE song_id = NEW.song_id
+        ON CONFLICT (artist_id) DO UPDATE SET song_count = song_count + excluded.song_count,
+                                              total_length = total_length + excluded.total_length;
+END;
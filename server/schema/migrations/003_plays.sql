@@ -0,0 +1,36 @@
+-- Play events: dictionaries of countries and sources, and the daily rollups the
+-- playcount analytics read. The monthly tables of raw events are created on first use.
+
+CREATE TABLE play_country (
+    country_id INTEGER PRIMARY KEY,
+    country TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE play_source (
+    source_id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE play_song_daily (
+    day INT NOT NULL,
+    song_id INT NOT NULL,
+    plays INT NOT NULL,
+    PRIMARY KEY (day, song_id)
+) WITHOUT ROWID;
+
+CREATE INDEX play_song_daily_by_plays ON play_song_daily (day, plays DESC, song_id);
+
+CREATE TABLE play_country_daily (
+    day INT NOT NULL,
+    country_id INT NOT NULL,
+    plays INT NOT NULL,
+    PRIMARY KEY (day, country_id)
+) WITHOUT ROWID;
+
+CREATE TABLE play_source_daily (
+    day INT NOT NULL,
+    song_id INT NOT NULL,
+    source_id INT NOT NULL,
+    plays INT NOT NULL,
+    PRIMARY KEY (day, song_id, source_id)
+) WITHOUT ROWID;
@@ -0,0 +1,13 @@
+-- The solo flag of albums (a single artist, and no other artist on any of its songs),
+-- maintained by DB.add_album, so /analytics/solo_albums reads a partial index instead
+-- of comparing the artists of every album with those of its songs.
+
+ALTER TABLE album ADD COLUMN solo INT NOT NULL DEFAULT 0;
+
+UPDATE album SET solo = (
+    (SELECT count(*) FROM artist_album AS aa WHERE aa.album_id = album.album_id) = 1
+    AND NOT EXISTS (SELECT 1 FROM song_album AS sa JOIN song_artist AS s USING (song_id)
+        WHERE sa.album_id = album.album_id AND s.artist_id NOT IN
+            (SELECT artist_id FROM artist_album AS aa WHERE aa.album_id = album.album_id)));
+
+CREATE INDEX album_solo ON album (album_id) WHERE solo = 1;
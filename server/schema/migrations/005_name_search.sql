@@ -0,0 +1,32 @@
+-- Full-text index of song, album and artist names for /search. Inserts into song, album
+-- and artist queue their names in name_search_pending, which DB moves into the index
+-- before each commit.
+
+CREATE VIRTUAL TABLE name_search USING fts5(name, kind UNINDEXED, id UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3');
+
+CREATE TABLE name_search_pending (
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    id INT NOT NULL
+);
+
+INSERT INTO name_search (name, kind, id)
+    SELECT song_name, 'song', song_id FROM song
+    UNION ALL SELECT album_name, 'album', album_id FROM album
+    UNION ALL SELECT artist_name, 'artist', artist_id FROM artist;
+
+CREATE TRIGGER song_name_search AFTER INSERT ON song
+BEGIN
+    INSERT INTO name_search_pending (name, kind, id) VALUES (NEW.song_name, 'song', NEW.song_id);
+END;
+
+CREATE TRIGGER album_name_search AFTER INSERT ON album
+BEGIN
+    INSERT INTO name_search_pending (name, kind, id) VALUES (NEW.album_name, 'album', NEW.album_id);
+END;
+
+CREATE TRIGGER artist_name_search AFTER INSERT ON artist
+BEGIN
+    INSERT INTO name_search_pending (name, kind, id) VALUES (NEW.artist_name, 'artist', NEW.artist_id);
+END;
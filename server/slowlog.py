@@ -0,0 +1,70 @@
+import json
+import logging
+import logging.handlers
+import os
+import sqlite3
+
+# Slow query log. A DB created with a SlowQueryLog passes it every statement it
+# runs (the registered ones in queries.py and the ad hoc SQL of run_sandboxed); a
+# statement that took threshold_ms or longer is logged as one JSON line with its
+# name, SQL, parameters, duration and EXPLAIN QUERY PLAN, eg
+#
+#   2024-05-01 12:00:00,000 {"ms": 182.4, "query": "songs_by_artist", "sql": "SELECT ...",
+#       "params": {"artist_id": 12, ...}, "plan": ["SEARCH sa USING COVERING INDEX ...", ...]}
+#
+# The plan is read right after the statement ran, on the same connection, so it
+# is the plan SQLite used.
+
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms, logger):
+        self.threshold = threshold_ms / 1000.0
+        self.logger = logger
+        self.logged = 0
+
+    # logs the statement if seconds is over the threshold. name is None for ad hoc SQL.
+    # the plan is read with plan_params when given, else with params
+    def check(self, conn, name, sql, params, seconds, plan_params=None):
+        if seconds < self.threshold:
+            return
+        self.logged += 1
+        plan = explain(conn, sql, params if plan_params is None else plan_params)
+        entry = {"ms": round(seconds * 1000, 3), "query": name, "sql": sql,
+                 "params": params, "plan": plan}
+        self.logger.warning(json.dumps(entry, default=repr))
+
+    # a batch from executemany is logged with its number of rows and the first row's
+    # parameters, which are also the ones the plan is read with
+    def check_many(self, conn, name, sql, seq_of_params, seconds):
+        if seconds < self.threshold:
+            return
+        first = seq_of_params[0] if seq_of_params else ()
+        self.check(conn, name, sql, {"rows": len(seq_of_params), "first": first}, seconds, first)
+
+
+# EXPLAIN QUERY PLAN of sql as a list of lines, indented like the sqlite3 shell does
+def explain(conn, sql, params=()):
+    try:
+        rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except (sqlite3.Error, ValueError) as e:
+        return ["(no plan: %s)" % e]
+    depth = {0: -1}
+    plan = []
+    for node, parent, unused, detail in rows:
+        depth[node] = depth.get(parent, -1) + 1
+        plan.append("  " * depth[node] + detail)
+    return plan
+
+
+# a logger writing to path, rolled over to path.1 .. path.<backups> every max_bytes
+def file_logger(path, max_bytes=10 * 1024 * 1024, backups=5, name="splatify.slow_queries"):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.WARNING)
+    # slow queries only go to the file, not the server log
+    logger.propagate = False
+    if not any(getattr(h, "baseFilename", None) == os.path.abspath(path) for h in logger.handlers):
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        logger.addHandler(handler)
+    return logger
+